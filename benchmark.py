@@ -0,0 +1,579 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Peter Hanecak <hanecak@opendata.sk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmarks of the parse/convert code of 'datastore_updater.py'.
+
+Works offline on synthetic CSV files generated from 'STRUCTURE' of the
+dataset classes, no CKAN nor config.ini is needed. Examples:
+
+    python benchmark.py convert --dataset ZakazkyAZmluvy --rows 20000
+    python benchmark.py dates --dataset Zakazky
+    python benchmark.py suite
+    python benchmark.py e2e --rows 5000 --latency 0.05
+"""
+
+import argparse
+import configparser
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import datastore_updater
+import fake_ckan
+
+
+def generate_value(item, rnd):
+    """Generate random value (as found in EKS CSV) for given STRUCTURE item."""
+
+    if item['type'] == 'timestamp':
+        if rnd.random() < 0.2:
+            return ''
+        # most of EKS timestamps are just dates (i.e. with '0:00:00')
+        if rnd.random() < 0.6:
+            return '%d.%d.%d 0:00:00' % (rnd.randint(1, 28), rnd.randint(1, 12),
+                rnd.randint(2014, 2019))
+        return '%d.%d.%d %d:%02d:%02d' % (rnd.randint(1, 28), rnd.randint(1, 12),
+            rnd.randint(2014, 2019), rnd.randint(0, 23), rnd.randint(0, 59),
+            rnd.randint(0, 59))
+    if item['type'] == 'float':
+        if rnd.random() < 0.2:
+            return ''
+        return '%d,%04d' % (rnd.randint(0, 1000000), rnd.randint(0, 9999))
+    if item['type'] == 'integer':
+        return str(rnd.randint(0, 1000))
+    if item['type'] == 'bool':
+        return rnd.choice(('True', 'False'))
+    words = ('Slovensko', 'Bratislava', 'dodávka', 'služby', 'a.s.', 's.r.o.', '12345678',
+        'Z2018', 'tovar')
+    if rnd.random() < 0.005:
+        # descriptions (e.g. of subject of contract) can be long, with quotes,
+        # commas and line breaks
+        return '\n'.join(' '.join(rnd.choice(words + ('"tovar"', 'a,', '-')) for i in range(20))
+            for j in range(rnd.randint(10, 200)))
+    return ' '.join(rnd.choice(words) for i in range(rnd.randint(0, 8)))
+
+
+def generate_csv(dataset_class, filename, rows, seed=0, first_key=0):
+    """Generate synthetic EKS CSV file (BOM and quoted header, ',' at the
+    end of lines) for given dataset class, with primary keys starting with
+    given number."""
+
+    rnd = random.Random(seed)
+    width = len(dataset_class.STRUCTURE)
+    with open(filename, 'w', newline='') as csvfile:
+        csvfile.write('﻿' + ','.join('"%s"' % item['id']
+            for item in dataset_class.STRUCTURE) + ',\n')
+        writer = csv.writer(csvfile, lineterminator='\n')
+        for i in range(rows):
+            row = [''] * (width + 1)
+            for item in dataset_class.STRUCTURE:
+                row[item['csvindex']] = generate_value(item, rnd)
+            for key in dataset_class.PRIMARY_KEYS:
+                for item in dataset_class.STRUCTURE:
+                    if item['id'] == key and item['type'] == 'text':
+                        row[item['csvindex']] = 'Z%d' % (first_key + i)
+            writer.writerow(row)
+
+
+def convert_row_loops(dataset_class, mapping, row):
+    """Reference: conversion of a row as originally done in 'update_month()'."""
+
+    rowjson = {}
+    for mitem in mapping:
+        rowjson[mitem] = row[mapping[mitem]]
+    for mitem in dataset_class.DATE_ITEM_NAMES:
+        rowjson[mitem] = dataset_class.convert_date(row[mapping[mitem]])
+    for mitem in dataset_class.FLOAT_ITEM_NAMES:
+        rowjson[mitem] = dataset_class.convert_float(row[mapping[mitem]])
+    for mitem in dataset_class.INT_ITEM_NAMES:
+        rowjson[mitem] = dataset_class.convert_int(row[mapping[mitem]])
+    return rowjson
+
+
+def read_rows(filename):
+    with open(filename, 'r') as csvfile:
+        return list(csv.reader(csvfile))[1:]
+
+
+def dataset_classes():
+    """Return all dataset classes (including old versions), sorted by name."""
+
+    return sorted((value for value in vars(datastore_updater).values()
+        if isinstance(value, type)
+            and issubclass(value, datastore_updater.EksBaseDatastoreUpdater)
+            and value is not datastore_updater.EksBaseDatastoreUpdater),
+        key=lambda dataset_class: dataset_class.__name__)
+
+
+def offline_updater(dataset_class, engine='row'):
+    """Return instance of given dataset class able to read CSV files (see
+    'read_month()') without config.ini and CKAN."""
+
+    updater = dataset_class.__new__(dataset_class)
+    updater.conversion_engine = engine
+    return updater
+
+
+def read_month(updater, filename):
+    """Read whole given file as 'update()' does (header check, parsing,
+    conversion, JSON encoding and fingerprints), returns number of rows and
+    seconds spent in stages (see 'read_rows()')."""
+
+    month = {'csvfn': filename, 'csvstat': os.stat(filename), 'resume': None}
+    rows = 0
+    # no "loading ..." messages
+    with contextlib.redirect_stdout(io.StringIO()):
+        for row in updater.read_month(month):
+            rows += 1
+    return rows, month['stages']
+
+
+def measure(name, function, rows):
+    start = time.perf_counter()
+    for row in rows:
+        function(row)
+    elapsed = time.perf_counter() - start
+    print('  %-30s %10.0f items/s' % (name, len(rows) / elapsed))
+
+
+def benchmark_convert(dataset_class, filename):
+    """Compare original per-row loops with compiled row converter."""
+
+    rows = read_rows(filename)
+    mapping = {}
+    for item in dataset_class.STRUCTURE:
+        mapping[item['id']] = item['csvindex']
+    convert_row, row_key, row_object, csv_key = dataset_class.row_functions()
+
+    # both have to produce the same JSON (and the same keys)
+    for row in rows:
+        assert convert_row_loops(dataset_class, mapping, row) == row_object(convert_row(row)), \
+            'compiled converter differs from per-row loops: %r' % row
+        assert csv_key(row) == row_key(convert_row(row)), 'csv_key differs: %r' % row
+
+    print('%s (%d columns, %d rows):' % (dataset_class.__name__,
+        len(dataset_class.STRUCTURE), len(rows)))
+    measure('per-row loops', lambda row: convert_row_loops(dataset_class, mapping, row), rows)
+    measure('compiled converter', convert_row, rows)
+
+
+def benchmark_engines(dataset_class, filename):
+    """Compare 'row' and 'columnar' conversion engines on whole chunks."""
+
+    if not datastore_updater.import_numpy_pandas():
+        exit('\'columnar\' conversion engine needs pandas (pip install pandas)')
+
+    rows = read_rows(filename)
+    chunks = [rows[i:i + datastore_updater.COLUMNAR_CHUNK_ROWS]
+        for i in range(0, len(rows), datastore_updater.COLUMNAR_CHUNK_ROWS)]
+    convert_row, row_key, row_object = dataset_class.row_functions()[:3]
+
+    # both engines have to produce the same JSON
+    for chunk in chunks:
+        expected = [json.dumps(row_object(convert_row(row))) for row in chunk]
+        actual = [json.dumps(row_object(values))
+            for values in dataset_class.convert_rows_columnar(chunk)]
+        assert expected == actual, 'columnar engine differs from row engine'
+
+    print('%s (%d columns, %d rows, chunks of %d rows):' % (dataset_class.__name__,
+        len(dataset_class.STRUCTURE), len(rows), datastore_updater.COLUMNAR_CHUNK_ROWS))
+    dataset_class.convert_date.cache_clear()
+    start = time.perf_counter()
+    for chunk in chunks:
+        [convert_row(row) for row in chunk]
+    elapsed = time.perf_counter() - start
+    print('  %-30s %10.0f items/s' % ('row', len(rows) / elapsed))
+    dataset_class.convert_date.cache_clear()
+    start = time.perf_counter()
+    for chunk in chunks:
+        dataset_class.convert_rows_columnar(chunk)
+    elapsed = time.perf_counter() - start
+    print('  %-30s %10.0f items/s' % ('columnar', len(rows) / elapsed))
+
+
+def benchmark_json(dataset_class, filename):
+    """Compare JSON encoding of rows with json and orjson."""
+
+    convert_row, row_key, row_object = dataset_class.row_functions()[:3]
+    rows = [row_object(convert_row(row)) for row in read_rows(filename)]
+
+    def encode_compact(rowjson):
+        return json.dumps(rowjson, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    print('%s (%d columns, %d rows):' % (dataset_class.__name__,
+        len(dataset_class.STRUCTURE), len(rows)))
+    measure('json.dumps (default)', lambda rowjson: json.dumps(rowjson).encode('utf-8'), rows)
+    measure('json.dumps (compact)', encode_compact, rows)
+    measure('dumps_json (without orjson)', datastore_updater.dumps_json, rows)
+    if datastore_updater.orjson is None:
+        print('  orjson not installed')
+        return
+    measure('orjson.dumps', datastore_updater.orjson.dumps, rows)
+
+    # fingerprints of rows must not depend on orjson being installed
+    for rowjson in rows:
+        assert datastore_updater.dumps_json(rowjson).encode('utf-8') == \
+            datastore_updater.orjson.dumps(rowjson), 'json and orjson differ: %r' % rowjson
+
+    # memory needed to build the upsert payload on top of the batch itself
+    data = {'resource_id': 'benchmark', 'method': 'upsert'}
+    tracemalloc.start()
+    json.dumps(dict(data, records=rows)).encode('utf-8')
+    whole = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    encoded = [datastore_updater.encode_json(rowjson) for rowjson in rows]
+    pieces = [datastore_updater.encode_json(data)] + encoded
+    tracemalloc.start()
+    for chunk in datastore_updater.RequestBody(pieces):
+        pass
+    streamed = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('  payload of %d bytes: %d bytes allocated as one string, %d bytes streamed'
+        % (len(datastore_updater.RequestBody(pieces)), whole, streamed))
+
+
+def benchmark_memory(dataset_class, filename):
+    """Compare memory taken by converted rows kept as tuples of values and as
+    dicts (JSON objects)."""
+
+    rows = read_rows(filename)[:datastore_updater.COLUMNAR_CHUNK_ROWS]
+    convert_row, row_key, row_object = dataset_class.row_functions()[:3]
+
+    print('%s (%d columns, %d rows):' % (dataset_class.__name__,
+        len(dataset_class.STRUCTURE), len(rows)))
+    for name, function in (
+            ('tuples', convert_row),
+            ('dicts', lambda row: row_object(convert_row(row)))):
+        dataset_class.convert_date.cache_clear()
+        tracemalloc.start()
+        converted = [function(row) for row in rows]
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del converted
+        print('  %-30s %10d bytes (%d bytes/row)' % (name, allocated, allocated / len(rows)))
+
+    measure('tuples + JSON', lambda row: datastore_updater.encode_json(
+        row_object(convert_row(row))), rows)
+
+
+def benchmark_suite(dataset_classes, rows, engine):
+    """Measure the whole parse/convert path (see 'read_month()') of given
+    dataset classes: rows per second (in total and per stage) and memory
+    allocated while reading."""
+
+    print('%-20s %7s %9s %9s %9s %9s %11s' % ('class', 'columns', 'rows/s', 'read/s',
+        'convert/s', 'encode/s', 'peak alloc'))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for dataset_class in dataset_classes:
+            filename = os.path.join(tmpdir, '%s.csv' % dataset_class.__name__)
+            generate_csv(dataset_class, filename, rows)
+            updater = offline_updater(dataset_class, engine)
+
+            dataset_class.convert_date.cache_clear()
+            start = time.perf_counter()
+            count, stages = read_month(updater, filename)
+            elapsed = time.perf_counter() - start
+            assert count == rows, '%d rows read, %d expected' % (count, rows)
+
+            # rows are streamed, so memory allocated while reading should not
+            # grow with size of the file (apart from the cache of converted
+            # dates, up to 'DATE_CACHE_SIZE' items)
+            dataset_class.convert_date.cache_clear()
+            tracemalloc.start()
+            read_month(updater, filename)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            result = {
+                'columns': len(dataset_class.STRUCTURE),
+                'rows': rows,
+                'rows_per_second': rows / elapsed,
+                'peak_allocated': peak,
+            }
+            for stage in ('read', 'convert', 'encode'):
+                result[stage + '_rows_per_second'] = rows / stages[stage]
+            results[dataset_class.__name__] = result
+            print('%-20s %7d %9.0f %9.0f %9.0f %9.0f %7.0f KiB' % (dataset_class.__name__,
+                result['columns'], result['rows_per_second'], result['read_rows_per_second'],
+                result['convert_rows_per_second'], result['encode_rows_per_second'],
+                peak / 1024))
+    return results
+
+
+def month_class(dataset_class, csvdate):
+    """Return class used for given month of given dataset (i.e. old version
+    of the class for months before 2018-10, if there is one), see
+    'month_updater()'."""
+
+    old_class = getattr(datastore_updater, dataset_class.__name__ + 'Old', None)
+    year, month = csvdate.split('-')
+    if old_class is not None and (int(year), int(month)) < (2018, 10):
+        return old_class
+    return dataset_class
+
+
+def benchmark_e2e(dataset_classes, rows, months, fake_options, main_options, jobs,
+        bulk_load=False):
+    """Run real 'setup' and 'update' (or 'bulk-load') commands for given dataset
+    classes in temporary directory against fake CKAN (see 'fake_ckan.py'), with given
+    options of the fake and options of the main section of config.ini.
+
+    Each dataset gets CSV files for given number of months (up to 2018-11,
+    so that old versions of classes are used too), each with given number of
+    rows, half of them updating rows of the previous month. Reports rows per
+    second and bytes sent and checks that the resources end up with the same
+    rows as the CSV files. Returns True if they do."""
+
+    csvdates = []
+    year, month = 2018, 11
+    for i in range(months):
+        csvdates.insert(0, '%d-%d' % (year, month))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+    ok = True
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir, fake_ckan.FakeCkan(**fake_options) as fake:
+        # CSV files and rows expected in DataStore afterwards
+        expected = {}
+        for dataset_class in dataset_classes:
+            directory = os.path.join(tmpdir, 'data', dataset_class.DIRECTORY_SUBDIR)
+            os.makedirs(directory)
+            records = expected[dataset_class] = {}
+            for i, csvdate in enumerate(csvdates):
+                filename = os.path.join(directory, dataset_class.CSV_FN_PATTERN_2 % csvdate)
+                updater = offline_updater(month_class(dataset_class, csvdate))
+                generate_csv(type(updater), filename, rows, i, i * rows // 2)
+                month = {'csvfn': filename, 'csvstat': os.stat(filename), 'resume': None}
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for row in updater.read_month(month):
+                        record = json.loads(row[3])
+                        records[tuple(record[key] for key in dataset_class.PRIMARY_KEYS)] = record
+
+        config = configparser.ConfigParser(interpolation=None)
+        config['main'] = dict(main_options, ckan_url=fake.url, api_key='benchmark',
+            directory_root=os.path.join(tmpdir, 'data'))
+        for dataset_class in dataset_classes:
+            name = 'eks-%s' % dataset_class.CONFIG_SECTION.replace('_', '-')
+            config[dataset_class.CONFIG_SECTION] = {
+                'dataset.name': name,
+                'dataset.title': name,
+                'dataset.notes': 'benchmark',
+                'resource.id': 'resource-%s' % name,
+                'resource.name': 'API',
+                'resource.notes': 'benchmark',
+            }
+        with open(os.path.join(tmpdir, 'config.ini'), 'w') as configfile:
+            config.write(configfile)
+
+        # the real thing, with output into a log file
+        os.chdir(tmpdir)
+        try:
+            with open('benchmark.log', 'w') as log, contextlib.redirect_stdout(log):
+                start = time.perf_counter()
+                for dataset_class in dataset_classes:
+                    dataset_class().setup()
+                setup_time = time.perf_counter() - start
+                start = time.perf_counter()
+                updated = datastore_updater.update_datasets(
+                    [dataset_class() for dataset_class in dataset_classes], jobs, bulk_load)
+                update_time = time.perf_counter() - start
+        except SystemExit as e:
+            print('error: %s' % e)
+            updated = False
+        finally:
+            os.chdir(cwd)
+        if not updated:
+            print('update failed, see output:')
+            with open(os.path.join(tmpdir, 'benchmark.log')) as log:
+                print(log.read()[-5000:])
+            return False
+
+        total = rows * months * len(dataset_classes)
+        print('%d datasets, %d months of %d rows each, %d rows in total' % (len(dataset_classes),
+            months, rows, total))
+        print('  %-20s %8.1f s' % ('setup', setup_time))
+        print('  %-20s %8.1f s, %.0f rows/s' % ('bulk-load' if bulk_load else 'update',
+            update_time, total / update_time))
+        for action, stats in sorted(fake.stats.items()):
+            print('  %-20s %8d calls (%d failed), %d records, %d bytes on wire' % (action,
+                stats['calls'], stats['errors'], stats['records'], stats['bytes']))
+        print('  %-20s %8d requests' % ('max in flight', fake.max_in_flight))
+
+        for dataset_class in dataset_classes:
+            name = 'eks-%s' % dataset_class.CONFIG_SECTION.replace('_', '-')
+            actual = fake.resources['resource-%s' % name]['rows']
+            records = expected[dataset_class]
+            missing = sum(1 for key in records if key not in actual)
+            extra = sum(1 for key in actual if key not in records)
+            different = sum(1 for key in records if key in actual and actual[key] != records[key])
+            result = 'OK'
+            if missing > 0 or extra > 0 or different > 0:
+                result = 'FAILED (%d missing, %d extra, %d different)' % (missing, extra, different)
+                ok = False
+            print('  %-20s %8d rows %s' % (dataset_class.CONFIG_SECTION, len(actual), result))
+    return ok
+
+
+def convert_date_strptime(eks_date):
+    """Reference: 'convert_date()' as originally done with strptime."""
+
+    if len(eks_date) <= 0:
+        return None
+    return datetime.datetime.strptime(eks_date, '%d.%m.%Y %H:%M:%S').isoformat()
+
+
+def call(function, value):
+    """Return result of function or type of exception raised by it."""
+
+    try:
+        return function(value)
+    except Exception as e:
+        return type(e)
+
+
+def check_dates(convert_date, values):
+    """Differential check of given date converter against strptime."""
+
+    rnd = random.Random(0)
+    values = list(values) + [
+        '5.3.2018 9:00:00', '05.03.2018 09:00:00', '29.2.2016 0:0:0', '29.2.2017 0:0:0',
+        '31.4.2018 1:00:00', '0.1.2018 1:00:00', '1.13.2018 1:00:00', '1.1.2018 24:00:00',
+        '1.1.2018 23:60:00', '1.1.2018 23:59:60', ' 5.3.2018 9:00:00', '5.3.2018  9:00:00',
+        '5.3.2018 9:00:00 ', '5.3.18 9:00:00', '5.3.2018 9:00', '001.3.2018 9:00:00',
+        '\u0661.3.2018 9:00:00', '', 'x']
+    for i in range(100000):
+        values.append('%d.%d.%04d %d:%d:%d' % (rnd.randint(0, 32), rnd.randint(0, 13),
+            rnd.randint(0, 2100), rnd.randint(0, 25), rnd.randint(0, 61), rnd.randint(0, 61)))
+        values.append(''.join(rnd.choice('0123456789. :') for j in range(rnd.randint(8, 20))))
+
+    mismatches = [value for value in values
+        if call(convert_date, value) != call(convert_date_strptime, value)]
+    if len(mismatches) > 0:
+        raise AssertionError('convert_date() differs from strptime for: %r' % mismatches[:10])
+    print('  %d values checked against strptime, all OK' % len(values))
+
+
+def benchmark_dates(dataset_class, filename):
+    """Compare strptime with 'convert_date()' on date columns of given file."""
+
+    rows = read_rows(filename)
+    indexes = [item['csvindex'] for item in dataset_class.STRUCTURE
+        if item['id'] in dataset_class.DATE_ITEM_NAMES]
+    values = [row[index] for row in rows for index in indexes]
+    convert_date = dataset_class.convert_date
+
+    print('%s (%d date values):' % (dataset_class.__name__, len(values)))
+    check_dates(convert_date.__wrapped__, values)
+    measure('strptime', convert_date_strptime, values)
+    measure('fast parser', convert_date.__wrapped__, values)
+    convert_date.cache_clear()
+    measure('fast parser with cache', convert_date, values)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=('convert', 'dates', 'engines', 'json', 'memory',
+        'suite', 'e2e',))
+    parser.add_argument('--dataset',
+        help='name of dataset class (default: ZakazkyAZmluvy, all for suite)')
+    parser.add_argument('--rows', type=int, default=20000,
+        help='number of rows in synthetic CSV file')
+    parser.add_argument('--engine', choices=('row', 'columnar'), default='row',
+        help='conversion engine used by suite')
+    parser.add_argument('--json', metavar='FILE',
+        help='write results of suite into given file (e.g. to compare runs in CI)')
+    parser.add_argument('--months', type=int, default=3,
+        help='number of CSV files per dataset for e2e (default: 3)')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of datasets updated in parallel by e2e')
+    parser.add_argument('--bulk-load', action='store_true',
+        help='run bulk-load instead of update in e2e')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+        help='option of main section of config.ini used by e2e, e.g. upload_workers=4')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds added to each call of fake CKAN (e2e)')
+    parser.add_argument('--latency-per-mb', type=float, default=0.0,
+        help='seconds added to each call of fake CKAN per MiB of request (e2e)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='probability of datastore_upsert failing with HTTP 503 (half of them after commit) '
+            'in fake CKAN (e2e)')
+    parser.add_argument('--max-body', type=int,
+        help='requests bigger than this (in bytes) fail with HTTP 413 in fake CKAN (e2e)')
+    args = parser.parse_args()
+
+    if args.benchmark == 'e2e':
+        classes = [dataset_class for dataset_class in dataset_classes()
+            if not dataset_class.__name__.endswith('Old')]
+        if args.dataset is not None:
+            classes = [getattr(datastore_updater, args.dataset)]
+        main_options = dict(option.split('=', 1) for option in args.set)
+        fake_options = {
+            'latency': args.latency,
+            'latency_per_mb': args.latency_per_mb,
+            'error_rate': args.error_rate,
+            'max_body': args.max_body,
+        }
+        if not benchmark_e2e(classes, args.rows, args.months, fake_options, main_options,
+                args.jobs, args.bulk_load):
+            exit(1)
+        exit()
+
+    if args.benchmark == 'suite':
+        if args.engine == 'columnar' and not datastore_updater.import_numpy_pandas():
+            exit('\'columnar\' conversion engine needs pandas (pip install pandas)')
+        classes = dataset_classes()
+        if args.dataset is not None:
+            classes = [getattr(datastore_updater, args.dataset)]
+        results = benchmark_suite(classes, args.rows, args.engine)
+        if args.json is not None:
+            with open(args.json, 'w') as output:
+                json.dump(results, output, indent=2)
+        exit()
+
+    dataset_class = getattr(datastore_updater, args.dataset or 'ZakazkyAZmluvy')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'benchmark.csv')
+        generate_csv(dataset_class, filename, args.rows)
+        if args.benchmark == 'convert':
+            benchmark_convert(dataset_class, filename)
+        elif args.benchmark == 'dates':
+            benchmark_dates(dataset_class, filename)
+        elif args.benchmark == 'engines':
+            benchmark_engines(dataset_class, filename)
+        elif args.benchmark == 'json':
+            benchmark_json(dataset_class, filename)
+        elif args.benchmark == 'memory':
+            benchmark_memory(dataset_class, filename)
@@ -26,16 +26,52 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import argparse
+import collections
+import concurrent.futures
 import configparser
 import csv
 import datetime
+import functools
+import hashlib
+import io
+import itertools
 import json
+import locale
+import math
+import multiprocessing
 import os
 import pickle
+import queue
+import random
+import re
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
 import requests
 
+# optional, faster JSON encoding (see 'encode_json()')
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# not available on all platforms, used only to report memory usage (see
+# 'peak_rss()')
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# optional, needed only for 'columnar' conversion engine and imported only
+# then (see 'import_numpy_pandas()'), as those take quite some memory
+numpy = None
+pandas = None
+
 USAGE = '''
 
     datastore_update.py setup
@@ -45,20 +81,1185 @@ USAGE = '''
         write in your configuration file if you want to regularly update the
         DataStore table with the `update` command.
 
-    datastore_update.py update
+    datastore_update.py update [--jobs N]
         Requests the last hour eartquakes from the remote server and pushes the
         records to the DataStore. You need to include the resource_id returned
         by the previous command to your configuration file before running this
         one. You should run this command periodically every each hour, eg with
-        cron job.
+        cron job. With '--jobs N', up to N datasets are updated in parallel.
+
+    datastore_update.py bulk-load [--jobs N]
+        Loads all CSV files into new (empty) DataStore resources at once,
+        much faster than the first 'update' would do. Rows from all files are
+        merged locally first (rows from later files replace rows with the same
+        primary key from earlier ones) and then inserted in big batches.
+        Regular 'update' continues after that.
 
 '''
 
 BATCH_SIZE = 10000
-STATE_FILE = 'datastore_updater.state'
+# defaults for batch sizing by size of payload, see 'BatchSizer'
+BATCH_BYTES = 8 * 1024 * 1024
+BATCH_BYTES_MIN = 64 * 1024
+BATCH_BYTES_MAX = 64 * 1024 * 1024
+BATCH_LATENCY = 10.0
+# defaults for batches inserted by 'bulk-load' (see 'bulk_load()')
+BULK_BATCH_SIZE = 100000
+BULK_BATCH_BYTES = 32 * 1024 * 1024
+# state of all datasets (see 'StateStore') and pickle file used for it before,
+# imported into it (see 'StateStore.get()')
+STATE_FILE = 'datastore_updater.state.sqlite'
+LEGACY_STATE_FILE = 'datastore_updater.state'
+# per-dataset local mirror of the DataStore resource (see 'Mirror'), '%s' is
+# replaced with CONFIG_SECTION
+MIRROR_FILE = 'datastore_updater.%s.sqlite'
+# per-dataset file with records rejected by CKAN (JSON, one record per line)
+REJECT_FILE = 'datastore_updater.%s.rejects'
+REJECT_LOCK = threading.Lock()
+# per-dataset file with rows having the same primary key as some previous row
+# in the same CSV file (JSON, one duplicate per line)
+DUPLICATE_FILE = 'datastore_updater.%s.duplicates'
+
+# HTTP status codes returned by 'datastore_upsert' which are not caused by data
+# in the batch (and thus are not worth retrying or bisecting the batch)
+FATAL_STATUS_CODES = (401, 403, 404, 405)
 
 # state keys
 STATE_LAST_PROCESSED = 'last_processed.'
+STATE_CHECKPOINT = 'checkpoint.'
+STATE_FILE_INFO = 'file_info.'
+STATE_BULK_LOAD = 'bulk_load.'
+
+# size of chunks used when reading CSV files without parsing them
+FILE_DIGEST_CHUNK = 1024 * 1024
+
+# size of blocks in which CSV files are read and decoded before parsing (larger
+# blocks were slower, as decoded text does not fit into CPU caches then)
+CSV_READ_BLOCK = 64 * 1024
+
+# dates used by EKS, e.g. '5.3.2018 9:00:00' (see 'convert_date()'), and size
+# of cache of converted dates (many rows share the same timestamps)
+EKS_DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4}) (\d{1,2}):(\d{1,2}):(\d{1,2})\Z', re.ASCII)
+DATE_CACHE_SIZE = 65536
+
+# number of rows converted at once by 'columnar' conversion engine
+COLUMNAR_CHUNK_ROWS = 10000
+
+# size of pieces in which request bodies are sent (see 'RequestBody')
+REQUEST_CHUNK = 65536
+
+# number of rows written into (or read from) staging table of the mirror at
+# once (see 'Mirror.stage()')
+STAGE_ROWS = 10000
+
+# number of primary keys kept in memory when looking for duplicates in a CSV
+# file, the index is moved to disk if there are more (see 'KeyIndex')
+KEY_INDEX_MAX_KEYS = 500000
+
+
+def import_numpy_pandas():
+    """Import numpy and pandas, returns False if those are not installed."""
+
+    global numpy, pandas
+    try:
+        import numpy
+        import pandas
+    except ImportError:
+        return False
+    return True
+
+
+def encode_json(data):
+    """Encode given data into compact JSON (bytes), with orjson if available.
+
+    Without orjson, the output is the same (see 'dumps_json()'), so that
+    fingerprints of rows (see 'row_fingerprint()') do not depend on orjson
+    being installed."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+    return dumps_json(data).encode('utf-8')
+
+
+def dumps_json(data):
+    """Encode given data into compact JSON (str) with json module, the same
+    way as orjson does, i.e. with floats formatted by 'format_float()'.
+
+    Usual data (rows and keys: no nested objects or lists and no floats
+    needing exponent) are encoded by 'json.dumps()' directly, which gives the
+    same output for them."""
+
+    if isinstance(data, dict):
+        values = data.values()
+    elif isinstance(data, (list, tuple)):
+        values = data
+    else:
+        values = (data,)
+    if not any(isinstance(value, (dict, list, tuple)) or isinstance(value, float)
+            and not (1e-4 <= abs(value) < 1e16 or value == 0) for value in values):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    if isinstance(data, float):
+        return format_float(data)
+    if isinstance(data, dict):
+        return '{%s}' % ','.join('%s:%s' % (json.dumps(key, ensure_ascii=False), dumps_json(value))
+            for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return '[%s]' % ','.join(dumps_json(value) for value in data)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def format_float(value):
+    """Format given float into JSON the same way as orjson does, e.g.:
+        1e+16 -> 1e16
+        1.5e-05 -> 0.000015
+        1e-06 -> 1e-6
+        NaN, Infinity -> null
+    """
+
+    if not math.isfinite(value):
+        return 'null'
+    mantissa, e, exponent = repr(value).partition('e')
+    if not e:
+        return mantissa
+    exponent = int(exponent)
+    if exponent == -5:
+        sign = '-' if mantissa.startswith('-') else ''
+        return sign + '0.0000' + mantissa.lstrip('-').replace('.', '')
+    return '%se%d' % (mantissa, exponent)
+
+
+class RequestBody:
+    """Request body made of pieces (bytes), sent piece by piece.
+
+    It has known length, thus requests sends it with 'Content-Length' (not
+    chunked) but without joining all pieces into one big copy first. It can
+    be iterated repeatedly, so the same body can be sent again on retry."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.length = sum(len(piece) for piece in pieces)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __iter__(self):
+        # join small pieces (e.g. single records) to avoid a send() call for
+        # each of them
+        chunk = []
+        chunk_size = 0
+        for piece in self.pieces:
+            chunk.append(piece)
+            chunk_size += len(piece)
+            if chunk_size >= REQUEST_CHUNK:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk_size > 0:
+            yield b''.join(chunk)
+
+
+class KeyIndex:
+    """Index of primary keys seen in a CSV file (with numbers of rows where
+    those were seen last), used to detect duplicates.
+
+    Keys are kept in a dict up to 'max_keys' keys, then the index is moved
+    into a temporary SQLite database on disk, so that huge files do not
+    exhaust memory."""
+
+    def __init__(self, max_keys=KEY_INDEX_MAX_KEYS):
+        self.max_keys = max_keys
+        self.keys = {}
+        self.db = None
+
+
+    def add(self, key, row):
+        """Note that given key was seen in given row, returns number of row
+        where it was seen before (or None)."""
+
+        if self.db is None:
+            previous = self.keys.get(key)
+            self.keys[key] = row
+            if len(self.keys) > self.max_keys:
+                self.spill()
+            return previous
+
+        encoded_key = encode_json(key)
+        found = self.db.execute('SELECT row FROM keys WHERE key = ?', (encoded_key,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO keys (key, row) VALUES (?, ?)',
+            (encoded_key, row))
+        return None if found is None else found[0]
+
+
+    def get(self, key):
+        """Return number of row where given key was seen last (or None)."""
+
+        if self.db is None:
+            return self.keys.get(key)
+        found = self.db.execute('SELECT row FROM keys WHERE key = ?',
+            (encode_json(key),)).fetchone()
+        return None if found is None else found[0]
+
+
+    def spill(self):
+        print('debug: more than %d keys, moving key index to disk' % self.max_keys)
+        # empty name means temporary database, deleted when closed
+        self.db = sqlite3.connect('')
+        self.db.execute('CREATE TABLE keys (key BLOB PRIMARY KEY, row INTEGER)')
+        self.db.executemany('INSERT INTO keys (key, row) VALUES (?, ?)',
+            ((encode_json(key), row) for key, row in self.keys.items()))
+        self.keys = {}
+
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        self.keys = {}
+
+
+class SpooledDigest:
+    """Digest computed by worker process (see 'spool_month()'), standing in
+    for hashlib object."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+    def hexdigest(self):
+        return self.value
+
+
+class FilePosition:
+    """Position in CSV file after some row, i.e. offset and digest (hashlib
+    object or 'SpooledDigest') of the data up to it, standing in for
+    'CsvFileReader' which moved on already (see 'read_rows()')."""
+
+    __slots__ = ('offset', 'digest')
+
+    def __init__(self, offset, digest):
+        self.offset = offset
+        self.digest = digest
+
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+# updaters (one per class) used in worker process, see 'spool_month()'
+SPOOL_UPDATERS = {}
+
+# set when the run gets interrupted (Ctrl-C), makes updates running in
+# threads stop, see 'update_datasets()'
+INTERRUPTED = threading.Event()
+
+
+def spool_month(updater_class, month):
+    """Read rows of given month (see 'read_month()') in worker process and
+    store them into temporary "spool" file.
+
+    Returns name of the file, position after the last row, info about the
+    file and seconds spent in stages of processing (see 'read_month()', with
+    digests as hex strings)."""
+
+    updater = SPOOL_UPDATERS.get(updater_class)
+    if updater is None:
+        updater = SPOOL_UPDATERS[updater_class] = updater_class()
+
+    fd, spool_fn = tempfile.mkstemp(prefix='datastore_updater.', suffix='.spool')
+    try:
+        with os.fdopen(fd, 'wb') as spool:
+            chunk = []
+            rows = updater.read_month(month, verbose=False)
+            for counter, position, key, encoded_row, fingerprint in rows:
+                chunk.append((counter, position.offset, position.hexdigest(), key,
+                    encoded_row, fingerprint))
+                if len(chunk) >= STAGE_ROWS:
+                    pickle.dump(chunk, spool, pickle.HIGHEST_PROTOCOL)
+                    chunk = []
+            pickle.dump(chunk, spool, pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        os.remove(spool_fn)
+        raise
+
+    counter, position = month['end']
+    return (spool_fn, (counter, position.offset, position.hexdigest()), month['info'],
+        month['stages'])
+
+
+class StateStore:
+    """State of all datasets (see 'STATE_*' keys) kept in SQLite database, one
+    row per key with value encoded as JSON.
+
+    Each save writes only keys which changed, in one transaction, and the
+    database is in WAL mode, so a crash can not leave the state half-written
+    and more datasets (also in more processes) can save their state at the
+    same time. Single instance (see 'get()') is shared by all datasets."""
+
+    # shared instances, see 'get()'
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # time of the last change is in ISO format (local time)
+        self.db.execute('CREATE TABLE IF NOT EXISTS state ('
+            'key TEXT PRIMARY KEY, '
+            'value TEXT NOT NULL, '
+            'updated TEXT NOT NULL)')
+        self.db.commit()
+        # key -> value (encoded) as stored in the database, see 'save()'
+        self.stored = {}
+
+
+    @classmethod
+    def get(cls, filename=STATE_FILE, legacy_filename=LEGACY_STATE_FILE):
+        """Return shared store, importing state from legacy pickle file (if
+        there is one) first."""
+
+        with cls.instances_lock:
+            if filename not in cls.instances:
+                store = cls(filename)
+                store.import_legacy(legacy_filename)
+                cls.instances[filename] = store
+            return cls.instances[filename]
+
+
+    def import_legacy(self, filename):
+        """Import state from given pickle file, if the store is still empty.
+        The file is then renamed (to '<filename>.migrated')."""
+
+        if not os.path.isfile(filename):
+            return
+
+        with self.lock:
+            if self.db.execute('SELECT COUNT(*) FROM state').fetchone()[0] == 0:
+                with open(filename, 'rb') as state_file:
+                    state = pickle.load(state_file)
+                now = datetime.datetime.now().isoformat()
+                with self.db:
+                    self.db.executemany('INSERT OR IGNORE INTO state (key, value, updated) '
+                        'VALUES (?, ?, ?)', [(key, json.dumps(value, sort_keys=True), now)
+                            for key, value in state.items()])
+                print('info: state imported from %s' % filename)
+        try:
+            os.replace(filename, filename + '.migrated')
+        except FileNotFoundError:
+            # migrated by other process meanwhile
+            pass
+
+
+    def load(self):
+        """Return state of all datasets (dict)."""
+
+        with self.lock:
+            self.stored = dict(self.db.execute('SELECT key, value FROM state'))
+            return {key: json.loads(value) for key, value in self.stored.items()}
+
+
+    def save(self, state, is_own):
+        """Save items of given state (dict) with keys for which 'is_own(key)'
+        is true: changed items are written and removed ones deleted, in one
+        transaction."""
+
+        with self.lock:
+            changed = []
+            for key, value in state.items():
+                if is_own(key):
+                    encoded = json.dumps(value, sort_keys=True)
+                    if self.stored.get(key) != encoded:
+                        changed.append((key, encoded))
+            removed = [key for key in self.stored if is_own(key) and key not in state]
+            if len(changed) == 0 and len(removed) == 0:
+                return
+
+            now = datetime.datetime.now().isoformat()
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO state (key, value, updated) '
+                    'VALUES (?, ?, ?)', [(key, encoded, now) for key, encoded in changed])
+                self.db.executemany('DELETE FROM state WHERE key = ?',
+                    [(key,) for key in removed])
+            for key, encoded in changed:
+                self.stored[key] = encoded
+            for key in removed:
+                del self.stored[key]
+
+
+class Mirror:
+    """Local mirror of DataStore resource: SQLite database with rows pushed
+    into the resource, keyed by primary key, each with its fingerprint (see
+    'row_fingerprint()') and with times when it was first seen and last
+    modified.
+
+    Used to find rows which changed since they were pushed (without asking
+    CKAN). Also keeps duplicates found in CSV files (see 'note_duplicates()').
+    Used by both reader and upload threads, thus access to it is
+    serialized."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        # key and record are encoded with 'encode_json()', times are in ISO
+        # format (local time)
+        self.db.execute('CREATE TABLE IF NOT EXISTS rows ('
+            'key BLOB PRIMARY KEY, '
+            'fingerprint BLOB NOT NULL, '
+            'record BLOB, '
+            'first_seen TEXT, '
+            'last_modified TEXT)')
+        # rows of CSV files (base names) with primary keys seen in earlier rows
+        # of the same file
+        self.db.execute('CREATE TABLE IF NOT EXISTS duplicates ('
+            'file TEXT, '
+            'key BLOB, '
+            'row INTEGER, '
+            'PRIMARY KEY (file, key, row))')
+        self.db.commit()
+
+
+    def fingerprint(self, key):
+        """Return fingerprint of row with given primary key, as last pushed
+        (or None if not pushed yet)."""
+
+        with self.lock:
+            found = self.db.execute('SELECT fingerprint FROM rows WHERE key = ?',
+                (encode_json(key),)).fetchone()
+        return None if found is None else found[0]
+
+
+    def store(self, keys, fingerprints, records):
+        """Store pushed records (encoded with 'encode_json()') with given
+        primary keys and fingerprints."""
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            self.db.executemany('INSERT INTO rows '
+                    '(key, fingerprint, record, first_seen, last_modified) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET '
+                    'fingerprint = excluded.fingerprint, '
+                    'record = excluded.record, '
+                    'last_modified = excluded.last_modified '
+                    'WHERE fingerprint != excluded.fingerprint OR record IS NULL',
+                ((encode_json(key), fingerprint, record, now, now)
+                    for key, fingerprint, record in zip(keys, fingerprints, records)))
+            self.db.commit()
+
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+
+
+    def note_duplicates(self, filename, duplicates):
+        """Note duplicates (tuples (key, row, previous row)) found in CSV file
+        of given base name. Returns those not noted before."""
+
+        noted = []
+        with self.lock:
+            for duplicate in duplicates:
+                cursor = self.db.execute('INSERT OR IGNORE INTO duplicates (file, key, row) '
+                    'VALUES (?, ?, ?)', (filename, encode_json(duplicate[0]), duplicate[1]))
+                if cursor.rowcount > 0:
+                    noted.append(duplicate)
+            self.db.commit()
+        return noted
+
+
+    def has_duplicates(self, filename):
+        """Check whether duplicates were found in CSV file of given base name
+        before."""
+
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM duplicates WHERE file = ? LIMIT 1',
+                (filename,)).fetchone() is not None
+
+
+    def start_staging(self):
+        """Create (new, empty) staging table, used to merge rows from all CSV
+        files before loading them into DataStore, see 'bulk_load()'."""
+
+        with self.lock:
+            self.db.execute('DROP TABLE IF EXISTS staged')
+            self.db.execute('CREATE TABLE staged ('
+                'key BLOB PRIMARY KEY, '
+                'fingerprint BLOB NOT NULL, '
+                'record BLOB NOT NULL)')
+            self.db.commit()
+
+
+    def stage(self, rows):
+        """Store rows (tuples (key, fingerprint, record), with key and record
+        encoded with 'encode_json()') into staging table, replacing rows with
+        the same key staged before."""
+
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO staged (key, fingerprint, record) '
+                'VALUES (?, ?, ?)', rows)
+            self.db.commit()
+
+
+    # staged rows not pushed yet: not in the mirror, or in it with different
+    # fingerprint (e.g. pushed by interrupted update from an earlier month)
+    STAGED_NOT_PUSHED = ('NOT EXISTS (SELECT 1 FROM rows '
+        'WHERE rows.key = staged.key AND rows.fingerprint = staged.fingerprint)')
+
+    def staged_count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM staged '
+                'WHERE ' + self.STAGED_NOT_PUSHED).fetchone()[0]
+
+
+    def staged_rows(self):
+        """Yield staged rows which are not in the mirror yet (or differ from
+        the row in the mirror), as tuples (primary key, fingerprint, record).
+
+        Rows are read in pages, so that the mirror can be updated meanwhile."""
+
+        last = 0
+        while True:
+            with self.lock:
+                page = self.db.execute('SELECT rowid, key, fingerprint, record FROM staged '
+                    'WHERE rowid > ? AND ' + self.STAGED_NOT_PUSHED + ' '
+                    'ORDER BY rowid LIMIT ?', (last, STAGE_ROWS)).fetchall()
+            if len(page) == 0:
+                return
+            last = page[-1][0]
+            for rowid, key, fingerprint, record in page:
+                yield tuple(json.loads(key)), fingerprint, record
+
+
+    def finish_staging(self):
+        with self.lock:
+            self.db.execute('DROP TABLE IF EXISTS staged')
+            self.db.commit()
+            self.db.execute('VACUUM')
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class CkanClient:
+    """Client for CKAN action API.
+
+    Single instance (see 'get()') is shared by all datasets, so that
+    connections to CKAN are kept alive and re-used (instead of doing new
+    TCP and TLS handshake for each call). Also keeps per-action latency
+    counters and limits number of 'datastore_upsert' requests being sent at
+    once by all datasets ('upload_slots', see 'post_upsert()')."""
+
+    # shared instances, see 'get()'
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, ckan_url, api_key, ssl_verify=True, pool_size=10, gzip_requests=False,
+            timeout=None, max_uploads=0):
+        self.ckan_url = ckan_url
+        self.api_key = api_key
+        self.ssl_verify = ssl_verify
+        self.gzip_requests = gzip_requests
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Content-type': 'application/json',
+            'Authorization': self.api_key})
+        self.adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        # action name -> [calls, total time, max time, bytes sent]
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+        # batches being uploaded by all datasets (None if not limited)
+        self.upload_slots = None
+        if max_uploads > 0:
+            self.upload_slots = threading.BoundedSemaphore(max_uploads)
+
+
+    @classmethod
+    def get(cls, ckan_url, api_key, ssl_verify=True, pool_size=10, gzip_requests=False,
+            timeout=None, max_uploads=0):
+        """Return shared client for given CKAN instance."""
+
+        key = (ckan_url, api_key, ssl_verify, pool_size, gzip_requests, timeout, max_uploads)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(*key)
+            return cls.instances[key]
+
+
+    def action(self, name, data, records=None):
+        """Call given CKAN API action with given data (dict), returns response.
+
+        If given, 'records' (list of records already encoded with
+        'encode_json()') are added to data as 'records' item. Those are sent
+        as they are, without building one more copy of the whole payload."""
+
+        pieces = [encode_json(data)]
+        if records is not None:
+            # '{...}' -> '{...,"records":[record,record,...]}'
+            pieces[0] = pieces[0][:-1] + (b',"records":[' if len(data) > 0 else b'"records":[')
+            for record in records:
+                pieces.append(record)
+                pieces.append(b',')
+            if len(records) > 0:
+                pieces.pop()
+            pieces.append(b']}')
+
+        headers = {}
+        if self.gzip_requests:
+            compressor = zlib.compressobj(5, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = [compressor.compress(piece) for piece in RequestBody(pieces)]
+            compressed.append(compressor.flush())
+            pieces = compressed
+            headers['Content-Encoding'] = 'gzip'
+        body = RequestBody(pieces)
+
+        start = time.time()
+        response = self.session.post(
+            '{0}/api/action/{1}'.format(self.ckan_url, name),
+            data=body,
+            headers=headers,
+            verify=self.ssl_verify,
+            timeout=self.timeout)
+        elapsed = time.time() - start
+
+        with self.stats_lock:
+            stats = self.stats.setdefault(name, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += len(body)
+
+        return response
+
+
+    def connections_opened(self):
+        """Return number of connections opened so far."""
+
+        pools = self.adapter.poolmanager.pools
+        return sum(getattr(pools[key], 'num_connections', 0) for key in pools.keys())
+
+
+    def print_stats(self):
+        with self.stats_lock:
+            for name, (calls, total, maximum, sent) in sorted(self.stats.items()):
+                print('  %-20s %5d calls, %.3f s avg, %.3f s max, %.1f s total, %d bytes sent'
+                    % (name, calls, total / calls, maximum, total, sent))
+        print('  %d connection(s) opened' % self.connections_opened())
+
+
+    @classmethod
+    def print_all_stats(cls):
+        with cls.instances_lock:
+            for client in cls.instances.values():
+                print('CKAN API calls to %s:' % client.ckan_url)
+                client.print_stats()
+
+
+class Metrics:
+    """Metrics of one run of one dataset, per CSV file: counters (rows, bytes
+    sent, retries, seconds spent in stages of processing) and latencies of
+    'datastore_upsert' calls, see 'EksBaseDatastoreUpdater.write_metrics()'.
+
+    Shared by threads uploading the batches."""
+
+    # upper bounds of buckets of the latency histogram, in seconds
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+    def __init__(self):
+        # file name -> {counter name -> value}
+        self.counters = {}
+        # file name -> list of latencies
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, filename, name, value):
+        with self.lock:
+            counters = self.counters.setdefault(filename, {})
+            counters[name] = counters.get(name, 0) + value
+
+
+    def observe(self, filename, latency):
+        with self.lock:
+            self.latencies.setdefault(filename, []).append(latency)
+
+
+    @staticmethod
+    def percentile(values, percent):
+        """Return given percentile (nearest rank) of given sorted values."""
+
+        return values[max(0, (len(values) * percent + 99) // 100 - 1)]
+
+
+    def summary(self):
+        """Return dict mapping file names to their counters, rows read per
+        second ('rows_per_second') and latency percentiles ('upsert_latency')."""
+
+        summary = {}
+        with self.lock:
+            for filename in sorted(set(self.counters) | set(self.latencies)):
+                item = dict(self.counters.get(filename, {}))
+                if item.get('seconds', 0) > 0:
+                    item['rows_per_second'] = item.get('rows_read', 0) / item['seconds']
+                latencies = sorted(self.latencies.get(filename, []))
+                if len(latencies) > 0:
+                    item['upsert_latency'] = {
+                        'count': len(latencies),
+                        'p50': self.percentile(latencies, 50),
+                        'p90': self.percentile(latencies, 90),
+                        'p99': self.percentile(latencies, 99),
+                        'max': latencies[-1],
+                    }
+                summary[filename] = item
+        return summary
+
+
+    def histogram(self, filename):
+        """Return latency histogram of given file: list of tuples (upper bound,
+        cumulative count) ending with '+Inf', sum and count."""
+
+        with self.lock:
+            latencies = self.latencies.get(filename, [])
+            buckets = []
+            for bound in self.LATENCY_BUCKETS:
+                buckets.append((repr(bound), sum(1 for latency in latencies if latency <= bound)))
+            buckets.append(('+Inf', len(latencies)))
+            return buckets, sum(latencies), len(latencies)
+
+
+def write_atomically(filename, data):
+    """Write given text into given file so that readers (e.g. node exporter)
+    never see it written partially: into temporary file in the same
+    directory first, which then replaces the file."""
+
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+        prefix='.' + os.path.basename(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmpfile:
+            tmpfile.write(data)
+        # readable by others (e.g. node exporter running as other user)
+        os.chmod(tmpfn, 0o644)
+        os.replace(tmpfn, filename)
+    except BaseException:
+        os.remove(tmpfn)
+        raise
+
+
+class BatchSizer:
+    """Decides when batch of records is big enough to be pushed.
+
+    Batches are limited by number of rows and by (estimated) size of the
+    payload in bytes. The byte limit is tuned based on observed latency of
+    'datastore_upsert': it grows while uploads are fast and shrinks when they
+    are slow, time out or get rejected as too big (HTTP 413). Only batches
+    rejected as too big limit the growth afterwards."""
+
+    def __init__(self, max_rows=BATCH_SIZE, target_bytes=BATCH_BYTES,
+            min_bytes=BATCH_BYTES_MIN, max_bytes=BATCH_BYTES_MAX, latency=BATCH_LATENCY):
+        self.max_rows = max_rows
+        self.target_bytes = target_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.latency = latency
+        # smallest batch size which was rejected as too big, we do not grow
+        # batches beyond that
+        self.too_big_bytes = None
+        self.lock = threading.Lock()
+
+
+    def is_full(self, rows, size):
+        return rows >= self.max_rows or size >= self.target_bytes
+
+
+    def limit_bytes(self, max_bytes):
+        """Do not let batches grow beyond given size (e.g. due to memory
+        constraints)."""
+
+        self.max_bytes = min(self.max_bytes, max_bytes)
+        self.min_bytes = min(self.min_bytes, self.max_bytes)
+        self.target_bytes = min(self.target_bytes, self.max_bytes)
+
+
+    def set_target(self, target_bytes, reason):
+        if self.too_big_bytes is not None:
+            target_bytes = min(target_bytes, self.too_big_bytes * 0.9)
+        target_bytes = int(min(self.max_bytes, max(self.min_bytes, target_bytes)))
+        if target_bytes != self.target_bytes:
+            print('debug: batch size limit changed from %d to %d bytes (%s)'
+                % (self.target_bytes, target_bytes, reason))
+            self.target_bytes = target_bytes
+
+
+    def success(self, size, elapsed):
+        """Batch of given size was pushed in given time (in seconds)."""
+
+        with self.lock:
+            if elapsed > self.latency:
+                self.set_target(self.target_bytes * 0.7, 'slow upload')
+            elif elapsed < self.latency / 2 and size >= self.target_bytes * 0.75:
+                # grow only if the batch was limited by size, not by rows or
+                # end of file (and after failures, approach the failed size
+                # only carefully)
+                if self.too_big_bytes is None:
+                    self.set_target(self.target_bytes * 1.5, 'fast upload')
+                else:
+                    self.set_target((self.target_bytes + self.too_big_bytes) / 2, 'fast upload')
+
+
+    def timed_out(self):
+        """Upload of a batch timed out (it is retried as it is, but CKAN might
+        be overloaded by big batches)."""
+
+        with self.lock:
+            self.set_target(self.target_bytes * 0.5, 'upload timed out')
+
+
+    def too_big(self, size):
+        """Batch of given size was rejected as too big."""
+
+        with self.lock:
+            if self.too_big_bytes is None or size < self.too_big_bytes:
+                self.too_big_bytes = size
+            self.set_target(min(self.target_bytes, size) * 0.5, 'batch too big')
+
+
+class BatchUploader:
+    """Pushes batches of records into datastore using background threads.
+
+    This way parsing of CSV file (done by caller of 'submit()') overlaps with
+    waiting for CKAN. Queue of batches waiting for upload is bounded, so
+    caller gets blocked if uploads fall behind, keeping memory usage bounded.
+
+    With more than one worker, batches may get pushed out of order. To keep
+    "last one wins" semantic of 'upsert' for rows sharing same primary key,
+    a batch is not queued until all in-flight batches with same keys are
+    done.
+
+    Optional 'on_ack' callback is called with marker of each batch once the
+    batch and all batches submitted before it were pushed, i.e. in order of
+    submission (used for checkpoints)."""
+
+    def __init__(self, upsert, workers=1, queue_size=2, on_ack=None):
+        self.upsert = upsert
+        self.on_ack = on_ack
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.condition = threading.Condition()
+        # primary key -> number of queued or in-flight batches containing it
+        self.in_flight_keys = {}
+        self.error = None
+
+        # sequence number of next submitted batch, of next batch to be
+        # acknowledged and markers of pushed but not yet acknowledged batches
+        self.next_seq = 0
+        self.next_ack = 0
+        self.pushed = {}
+        self.ack_lock = threading.Lock()
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            seq, records, keys, size, marker = item
+            try:
+                # after failure (or interrupt), just drain the queue
+                if self.error is None and not INTERRUPTED.is_set():
+                    self.upsert(records, size)
+                    self.ack(seq, marker)
+            except BaseException as e:
+                # 'upsert()' calls 'exit()' on errors, thus BaseException
+                with self.condition:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.release(keys)
+
+
+    def ack(self, seq, marker):
+        with self.ack_lock:
+            self.pushed[seq] = marker
+            while self.next_ack in self.pushed:
+                marker = self.pushed.pop(self.next_ack)
+                self.next_ack += 1
+                if self.on_ack is not None:
+                    self.on_ack(marker)
+
+
+    def release(self, keys):
+        with self.condition:
+            for key in keys:
+                self.in_flight_keys[key] -= 1
+                if self.in_flight_keys[key] == 0:
+                    del self.in_flight_keys[key]
+            self.condition.notify_all()
+
+
+    def put(self, item):
+        """Put item into queue, giving up if some upload already failed."""
+
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+    def submit(self, records, keys, size, marker=None):
+        """Queue batch of records (with given primary keys and estimated size
+        in bytes) for upload.
+
+        Empty batches are not pushed, but still acknowledged in order (so
+        that e.g. a checkpoint can be made also after rows which needed no
+        upload). Raises KeyboardInterrupt if the run was interrupted."""
+
+        if INTERRUPTED.is_set():
+            raise KeyboardInterrupt()
+        with self.condition:
+            while self.error is None and any(key in self.in_flight_keys for key in keys):
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            for key in keys:
+                self.in_flight_keys[key] = self.in_flight_keys.get(key, 0) + 1
+            seq = self.next_seq
+            self.next_seq += 1
+
+        if len(records) == 0:
+            self.ack(seq, marker)
+            return
+
+        try:
+            self.put((seq, records, keys, size, marker))
+        except BaseException:
+            self.release(keys)
+            raise
+
+
+    def close(self):
+        """Wait for all queued batches to be pushed.
+
+        Re-raises error from failed upload, if any. Raises KeyboardInterrupt
+        if the run was interrupted (queued batches might have been dropped)."""
+
+        for worker in self.workers:
+            # not using 'put()', workers keep draining the queue after failure
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+        if self.error is not None:
+            raise self.error
+        if INTERRUPTED.is_set():
+            raise KeyboardInterrupt()
+
+
+class CsvFileReader:
+    """Feeds lines of CSV file (opened in binary mode) to 'csv.reader()' while
+    keeping track of byte offset in the file and digest of the data read.
+
+    As 'csv.reader()' consumes only as many lines as needed for a row,
+    'offset' points right after the last row returned by the reader, which
+    allows us to resume processing from there later (see 'skip_to()').
+
+    The file is read and decoded in blocks (cut at line ends) and lines are
+    fed to the reader from 'io.StringIO()', so that no Python code runs per
+    line. 'offset', 'digest' and 'complete_line' are computed only when asked
+    for (see 'sync()'), e.g. when a batch of rows is complete."""
+
+    def __init__(self, csvfile, encoding=None):
+        self.csvfile = csvfile
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        # data read ahead: incomplete line after the last block and blocks
+        # not started yet
+        self.rest = b''
+        self.pending = collections.deque()
+        # current block: its offset in the file, data, decoded text (with
+        # the same line ending translation as done by files opened in text
+        # mode), whether the translation removed '\r' from every line and
+        # whether the text is ASCII (one byte per character)
+        self.block_offset = 0
+        self.block = b''
+        self.text = ''
+        self.crlf = False
+        self.ascii = True
+        self.lines = io.StringIO()
+        # part of the current block consumed by the reader (as seen by the
+        # last 'sync()'), in characters of 'text' and in bytes of 'block',
+        # and digest of the file up to there
+        self.text_pos = 0
+        self.block_pos = 0
+        self._digest = hashlib.blake2b()
+        # whether data before the current block end with complete line
+        self.block_complete_line = True
+
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.read_blocks())
+
+
+    def read_blocks(self):
+        """Read the file in blocks ending with complete lines (but the last
+        one), yielding lines of each block."""
+
+        while True:
+            if len(self.pending) == 0:
+                data = self.csvfile.read(CSV_READ_BLOCK)
+                if len(data) == 0:
+                    if len(self.rest) == 0:
+                        return
+                    block, self.rest = self.rest, b''
+                else:
+                    data = self.rest + data
+                    end = data.rfind(b'\n') + 1
+                    block, self.rest = data[:end], data[end:]
+                    if len(block) == 0:
+                        continue
+
+                crlf = block.count(b'\r\n') if b'\r' in block else 0
+                if crlf == 0 or crlf == block.count(b'\n'):
+                    self.pending.append(block)
+                else:
+                    # mixed line endings, translated per line
+                    self.pending.extend(io.BytesIO(block))
+
+            yield self.start_block(self.pending.popleft())
+
+
+    def start_block(self, block):
+        # the reader consumed all lines of the previous block
+        self._digest.update(memoryview(self.block)[self.block_pos:])
+        self.block_offset += len(self.block)
+        if len(self.block) > 0:
+            self.block_complete_line = self.block.endswith(b'\n')
+
+        self.block = block
+        self.text = block.decode(self.encoding)
+        self.crlf = b'\r\n' in block
+        if self.crlf:
+            self.text = self.text.replace('\r\n', '\n')
+        self.ascii = self.text.isascii()
+        self.lines = io.StringIO(self.text, newline='\n')
+        self.text_pos = 0
+        self.block_pos = 0
+        return self.lines
+
+
+    def sync(self):
+        """Update position and digest to the lines consumed by the reader."""
+
+        pos = self.lines.tell()
+        if pos == self.text_pos:
+            return
+        if self.ascii:
+            size = pos - self.text_pos
+        else:
+            size = len(self.text[self.text_pos:pos].encode(self.encoding))
+        if self.crlf:
+            size += self.text.count('\n', self.text_pos, pos)
+        self._digest.update(memoryview(self.block)[self.block_pos:self.block_pos + size])
+        self.text_pos = pos
+        self.block_pos += size
+
+
+    @property
+    def offset(self):
+        self.sync()
+        return self.block_offset + self.block_pos
+
+
+    @property
+    def digest(self):
+        self.sync()
+        return self._digest
+
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+    def position(self):
+        """Return current position, which stays valid when reading on."""
+
+        self.sync()
+        return FilePosition(self.block_offset + self.block_pos, self._digest.copy())
+
+
+    @property
+    def complete_line(self):
+        """Whether data read so far end with complete line."""
+
+        self.sync()
+        if self.block_pos == 0:
+            return self.block_complete_line
+        return self.block[self.block_pos - 1] == ord('\n')
+
+
+    def skip_to(self, offset):
+        """Skip data up to given offset (without parsing it). Data read ahead
+        are dropped and the file is read again from the current position."""
+
+        self.block_complete_line = self.complete_line
+        self.block_offset = self.offset
+        self.csvfile.seek(self.block_offset)
+        self.rest = b''
+        self.pending.clear()
+        # make the reader move on to the next block
+        self.lines.seek(0, io.SEEK_END)
+        self.block = b''
+        self.text = ''
+        self.lines = io.StringIO()
+        self.text_pos = 0
+        self.block_pos = 0
+
+        while self.block_offset < offset:
+            data = self.csvfile.read(min(offset - self.block_offset, FILE_DIGEST_CHUNK))
+            if len(data) == 0:
+                break
+            self.block_offset += len(data)
+            self._digest.update(data)
+            self.block_complete_line = data.endswith(b'\n')
+
+
+    @staticmethod
+    def file_digest(filename, size=None):
+        """Compute digest of whole file or of its first 'size' bytes (matching
+        'digest' of the reader)."""
+
+        digest = hashlib.blake2b()
+        with open(filename, 'rb') as f:
+            while size is None or size > 0:
+                chunk = FILE_DIGEST_CHUNK if size is None else min(size, FILE_DIGEST_CHUNK)
+                data = f.read(chunk)
+                if len(data) == 0:
+                    break
+                digest.update(data)
+                if size is not None:
+                    size -= len(data)
+        return digest.hexdigest()
 
 
 class EksBaseDatastoreUpdater:
@@ -67,8 +1268,7 @@ class EksBaseDatastoreUpdater:
     # basic per-dataset stuff, here set to None, proper values set in derived classes
     CONFIG_SECTION = None
     DIRECTORY_SUBDIR = None
-    CSV_FN_PATTERN = None
-    #  FIXME: rework 'next_csvdate()' & co. to pass timestamp so that we do not neeed this crude hack:
+    # file name with '%s' standing for CSV date, see 'list_csv_files()'
     CSV_FN_PATTERN_2 = None
 
     # description of dataset structure/schema for data in datastore
@@ -85,6 +1285,28 @@ class EksBaseDatastoreUpdater:
 
     def __init__(self):
         self.state = {}
+        # local mirror of the DataStore resource (opened lazily, see
+        # 'open_mirror()')
+        self.mirror = None
+        # available CSV files (scanned once, see 'list_csv_files()')
+        self.csv_files = None
+        # number of records skipped as unchanged, number of duplicates (rows
+        # with primary key seen before in the same file, and those not
+        # reported before) and number of rows replaced by later row with the
+        # same key (in the same batch or file), see 'batch_rows()'
+        self.skipped = 0
+        self.duplicates = 0
+        self.reported_duplicates = 0
+        self.collapsed = 0
+        # number of records rejected by CKAN and their keys, see 'reject()'
+        self.rejected = 0
+        self.rejected_keys = set()
+        # progress of 'bulk_load()', see 'bulk_checkpoint()'
+        self.bulk_progress = None
+        # metrics of this run and name of the file (see 'push_month()') being
+        # pushed, see 'write_metrics()'
+        self.metrics = Metrics()
+        self.metrics_file = ''
 
         # items from main section, common to all EKS datasets
         config = configparser.SafeConfigParser()
@@ -97,6 +1319,45 @@ class EksBaseDatastoreUpdater:
         self.ckan_url = config.get('main', 'ckan_url').rstrip('/')
         self.api_key = config.get('main', 'api_key')
         self.ssl_verify = config.getboolean('main', 'ssl_verify', fallback=True)
+        # number of concurrent 'datastore_upsert' requests of all datasets
+        # (0 means no limit other than 'upload_workers' per dataset)
+        upload_workers_total = config.getint('main', 'upload_workers_total', fallback=0)
+        if upload_workers_total < 0:
+            exit('upload_workers_total in the main section of the config.ini file can ' +
+                 'not be negative')
+        self.ckan = CkanClient.get(self.ckan_url, self.api_key, self.ssl_verify,
+            config.getint('main', 'http_pool_size', fallback=10),
+            config.getboolean('main', 'http_gzip', fallback=False),
+            config.getfloat('main', 'http_timeout', fallback=300),
+            upload_workers_total)
+        # retries of failed 'datastore_upsert' calls, with exponential backoff
+        # (base delay in seconds)
+        self.upsert_retries = config.getint('main', 'upsert_retries', fallback=5)
+        self.upsert_backoff = config.getfloat('main', 'upsert_backoff', fallback=1.0)
+        # number of concurrent 'datastore_upsert' requests and number of
+        # batches which may wait for upload, see 'BatchUploader'
+        self.upload_workers = config.getint('main', 'upload_workers', fallback=1)
+        self.upload_queue_size = config.getint('main', 'upload_queue_size', fallback=2)
+        # 'row' (convert row by row) or 'columnar' (convert chunks of rows
+        # column by column using pandas), see 'read_rows()'
+        self.conversion_engine = config.get('main', 'conversion_engine', fallback='row')
+        if self.conversion_engine not in ('row', 'columnar'):
+            exit('conversion_engine in the main section of the config.ini file has ' +
+                 'to be \'row\' or \'columnar\'')
+        if self.conversion_engine == 'columnar' and not import_numpy_pandas():
+            exit('\'columnar\' conversion engine needs pandas (pip install pandas)')
+        # number of worker processes reading (parsing and converting) CSV files
+        # ahead when more months are to be processed, see 'read_months()'
+        self.parse_workers = config.getint('main', 'parse_workers', fallback=1)
+        if self.parse_workers < 1:
+            exit('parse_workers in the main section of the config.ini file has to be ' +
+                 'at least 1')
+        # directory to write metrics into after each run (disabled if empty),
+        # see 'write_metrics()'
+        self.metrics_dir = config.get('main', 'metrics_dir', fallback='')
+        if self.upload_workers < 1 or self.upload_queue_size < 1:
+            exit('upload_workers and upload_queue_size in the main section of the ' +
+                 'config.ini file have to be at least 1')
 
         self.directory_root = config.get('main', 'directory_root')
         if not self.directory_root:
@@ -120,21 +1381,66 @@ class EksBaseDatastoreUpdater:
         self.resource_name = config.get(self.CONFIG_SECTION, 'resource.name')
         self.resource_notes = config.get(self.CONFIG_SECTION, 'resource.notes')
 
+        # batch sizing, see 'BatchSizer'
+        self.batch_sizer = BatchSizer(
+            config.getint(self.CONFIG_SECTION, 'batch.rows', fallback=BATCH_SIZE),
+            config.getint(self.CONFIG_SECTION, 'batch.bytes', fallback=BATCH_BYTES),
+            config.getint(self.CONFIG_SECTION, 'batch.bytes_min', fallback=BATCH_BYTES_MIN),
+            config.getint(self.CONFIG_SECTION, 'batch.bytes_max', fallback=BATCH_BYTES_MAX),
+            config.getfloat(self.CONFIG_SECTION, 'batch.latency', fallback=BATCH_LATENCY))
+        # Memory (in bytes) available for batches of records: batches waiting
+        # in the upload queue, batches being uploaded and the one being built
+        # have to fit in.
+        memory_budget = config.getint('main', 'memory_budget', fallback=0)
+        if memory_budget > 0:
+            self.batch_sizer.limit_bytes(
+                memory_budget // (self.upload_queue_size + self.upload_workers + 1))
+
+
+    def is_own_state_key(self, key):
+        """Check whether given state key belongs to this dataset."""
+
+        return key.endswith('.' + self.CONFIG_SECTION)
+
 
     def load_state(self):
-        if not os.path.isfile(STATE_FILE):
+        self.state = StateStore.get().load()
+        if not any(self.is_own_state_key(key) for key in self.state):
             print('info: no previous state found (%s)' % STATE_FILE)
-            return
-
-        state_file = open(STATE_FILE, "rb");
-        self.state = pickle.load(state_file);
-        state_file.close()
 
 
     def save_state(self):
-        state_file = open(STATE_FILE, "wb");
-        pickle.dump(self.state, state_file);
-        state_file.close()
+        """Save state of this dataset.
+
+        Other datasets may be updated at the same time, thus only items
+        belonging to this dataset (and only those which changed) are saved,
+        see 'StateStore'."""
+
+        StateStore.get().save(self.state, self.is_own_state_key)
+
+
+    def mirror_file(self):
+        return MIRROR_FILE % self.CONFIG_SECTION
+
+
+    def open_mirror(self):
+        """Open local mirror of DataStore resource (see 'Mirror'), if not
+        opened yet, and return it."""
+
+        if self.mirror is not None:
+            return self.mirror
+
+        mirror_fn = self.mirror_file()
+        if not os.path.isfile(mirror_fn):
+            print('info: no mirror found, creating %s' % mirror_fn)
+        self.mirror = Mirror(mirror_fn)
+        return self.mirror
+
+
+    def close_mirror(self):
+        if self.mirror is not None:
+            self.mirror.close()
+            self.mirror = None
 
 
     def exit(self, msg=USAGE):
@@ -154,12 +1460,7 @@ class EksBaseDatastoreUpdater:
         if not self.dataset_owner is None:
             data['owner_org'] = self.dataset_owner
 
-        response = requests.post(
-            '{0}/api/action/package_create'.format(self.ckan_url),
-            data=json.dumps(data),
-            headers={'Content-type': 'application/json',
-                     'Authorization': self.api_key},
-            verify=self.ssl_verify)
+        response = self.ckan.action('package_create', data)
 
         if response.status_code != 200:
             exit('Error creating dataset: {0}'.format(response.content))
@@ -192,17 +1493,27 @@ class EksBaseDatastoreUpdater:
             'primary_key': self.PRIMARY_KEYS,
         }
 
-        response = requests.post(
-            '{0}/api/action/datastore_create'.format(self.ckan_url),
-            data=json.dumps(data),
-            headers={'Content-type': 'application/json',
-                     'Authorization': self.api_key},
-            verify=self.ssl_verify)
+        response = self.ckan.action('datastore_create', data)
 
         if response.status_code != 200:
             exit('Error: {0}'.format(response.content))
 
         resource_id = response.json()['result']['resource_id']
+
+        # New (empty) resource => start with new (empty) mirror, rows pushed
+        # previously (if any) are no longer there.
+        if os.path.isfile(self.mirror_file()):
+            os.remove(self.mirror_file())
+        self.open_mirror()
+        self.close_mirror()
+
+        # Same for the state (last processed file, checkpoints, ...), so that
+        # all the files get pushed into the new resource.
+        self.load_state()
+        for key in [key for key in self.state if self.is_own_state_key(key)]:
+            del self.state[key]
+        self.save_state()
+
         print('''
 Dataset and DataStore resource successfully created with {0} records.
 Please add the resource id to your ini file:
@@ -212,6 +1523,41 @@ resource_id={1}
         '''.format(len(records), resource_id, self.CONFIG_SECTION))
 
 
+    def list_csv_files(self):
+        """List CSV files available for this dataset, one per month.
+
+        The directory is scanned only once, the result is kept for the rest of
+        the run. Returns dict mapping CSV dates (e.g. '2018-3') to tuples
+        (file name, stat), ordered by year and month. Some months might be
+        missing (gaps)."""
+
+        if self.csv_files is not None:
+            return self.csv_files
+
+        prefix, suffix = self.CSV_FN_PATTERN_2.split('%s')
+        name_re = re.compile(re.escape(prefix) + r'(\d{4})-([1-9]|1[0-2])' +
+            re.escape(suffix) + r'\Z')
+        csv_dir = os.path.join(self.directory_root, self.DIRECTORY_SUBDIR)
+        found = []
+        ignored = 0
+        with os.scandir(csv_dir) as entries:
+            for entry in entries:
+                match = name_re.match(entry.name)
+                if match is None or not entry.is_file():
+                    ignored += 1
+                    continue
+                found.append(((int(match.group(1)), int(match.group(2))),
+                    entry.path, entry.stat()))
+        if ignored > 0:
+            print("debug: %d other items in %s, skipping" % (ignored, csv_dir))
+
+        found.sort()
+        self.csv_files = {}
+        for (year, month), csvfn, csvstat in found:
+            self.csv_files['%d-%d' % (year, month)] = (csvfn, csvstat)
+        return self.csv_files
+
+
     def find_oldest_csvdate(self):
         """Find oldest CSV file in the given directory.
 
@@ -223,41 +1569,38 @@ resource_id={1}
             ZoznamZakaziekReport_2018-3_.csv
             ZoznamZakaziekReport_2018-4_.csv
 
-        So here, '2018-3' (a.k.a. "CVS date") would be returned."""
-
-        # list the self.directory_root + DIRECTORY_SUBDIR, skip directories, parse out
-        # available dates (YYYY-M) from file names
-        csv_dir = os.path.join(self.directory_root, self.DIRECTORY_SUBDIR)
-        file_dates = []
-        for diritem in os.listdir(csv_dir):
-            if not os.path.isfile(os.path.join(csv_dir, diritem)):
-                continue
-            try:
-                zdate = datetime.datetime.strptime(diritem, self.CSV_FN_PATTERN)
-                file_dates.append(zdate)
-            except ValueError:
-                print("debug: file %s does not match, skipping" % diritem)
+        So here, '2018-3' (a.k.a. "CVS date") would be returned (or None if
+        there are no files)."""
 
-        file_dates.sort()
-        return '{d.year}-{d.month}'.format(d = file_dates[0])
+        return next(iter(self.list_csv_files()), None)
 
 
-    @staticmethod
-    def next_csvdate(csvdate):
-        """Determine next CSV date.
+    def csvdates_from(self, csvdate):
+        """Return CSV dates of available files, starting with given one (or the
+        first one after it, if there is no file for it).
 
-        Here, we simpe do "+1 month", assuming we do not have gaps in our
-        CSV copy and if file is not founf, then "we went too far into
-        future, no file available yet".
+        Missing months (gaps) are reported and skipped."""
 
-        Example:
+        def year_month(csvdate):
+            year, month = csvdate.split('-')
+            return int(year), int(month)
 
-            '2018-3' -> '2018-4'
-        """
-
-        zdate = datetime.datetime.strptime(csvdate, '%Y-%m')
-        ztimedelta = datetime.timedelta(days=31)
-        return '{d.year}-{d.month}'.format(d = (zdate + ztimedelta))
+        first = year_month(csvdate)
+        csvdates = []
+        previous = None
+        for available in self.list_csv_files():
+            current = year_month(available)
+            if current < first:
+                continue
+            expected = None
+            if previous is not None:
+                expected = (previous[0] + previous[1] // 12, previous[1] % 12 + 1)
+            if expected is not None and current != expected:
+                print("warning: no files for months between %d-%d and %s, skipping" % (
+                    previous + (available,)))
+            csvdates.append(available)
+            previous = current
+        return csvdates
 
 
     def csv_header_check(self, row):
@@ -288,15 +1631,25 @@ resource_id={1}
 
 
     @staticmethod
+    @functools.lru_cache(maxsize=DATE_CACHE_SIZE)
     def convert_date(eks_date):
         """Convert date used by EKS to ISO date, e.g.:
             '5.3.2018 9:00:00' -> '2018-03-05T09:00:00'
+
+        Dates in the usual format are parsed directly (strptime is slow),
+        anything else is left to strptime, so the result (or error) is
+        always the same as with strptime.
         """
 
         if len(eks_date) <= 0:
             return None
 
-        date = datetime.datetime.strptime(eks_date, '%d.%m.%Y %H:%M:%S')
+        match = EKS_DATE_RE.match(eks_date)
+        if match is None:
+            date = datetime.datetime.strptime(eks_date, '%d.%m.%Y %H:%M:%S')
+        else:
+            day, month, year, hour, minute, second = map(int, match.groups())
+            date = datetime.datetime(year, month, day, hour, minute, second)
         # FIXME: While we are at it, we may add proper time zone (EKS is
         # pressumably using "Europe/Bratislava") so as to have proper
         # timestamps.
@@ -329,122 +1682,849 @@ resource_id={1}
         return eks_int.strip("'")
 
 
-    def upsert(self, records):
-        """Upsert given records into data store."""
+    @classmethod
+    def row_functions(cls):
+        """Return functions for rows of this dataset.
+
+        Rows travel as tuples of values (in 'STRUCTURE' order), which take
+        much less memory than dicts keyed by item names. They are converted
+        into JSON objects only when being encoded. The functions (generated
+        once per class from 'STRUCTURE', 'PRIMARY_KEYS' and '*_ITEM_NAMES')
+        are:
+
+            def convert_row(row):
+                # row from CSV -> tuple of values
+                return (
+                    row[0],
+                    convert_date(row[33]),
+                    ...
+                )
+
+            def row_key(values):
+                # tuple of values -> primary key
+                return (values[0],)
+
+            def row_object(values):
+                # tuple of values -> JSON object
+                return {
+                    'IdentifikatorZakazky': values[0],
+                    'DatumZazmluvnenia': values[1],
+                    ...
+                }
+
+            def csv_key(row):
+                # row from CSV -> primary key, same as row_key(convert_row(row))
+                return (row[0],)
+        """
 
-        if len(records) == 0:
+        # cached in the class itself (not inherited from the base class)
+        if '_row_functions' in cls.__dict__:
+            return cls._row_functions
+
+        # the later wins, same as when items were "fixed" one type after another
+        converters = {}
+        for name in cls.DATE_ITEM_NAMES:
+            converters[name] = 'convert_date'
+        for name in cls.FLOAT_ITEM_NAMES:
+            converters[name] = 'convert_float'
+        for name in cls.INT_ITEM_NAMES:
+            converters[name] = 'convert_int'
+
+        values = []
+        items = []
+        positions = {}
+        expressions = {}
+        for position, item in enumerate(cls.STRUCTURE):
+            value = 'row[%d]' % item['csvindex']
+            if item['id'] in converters:
+                value = '%s(%s)' % (converters[item['id']], value)
+            values.append('        %s,' % value)
+            items.append('        %r: values[%d],' % (item['id'], position))
+            positions[item['id']] = position
+            expressions[item['id']] = value
+        key = ''.join('values[%d], ' % positions[name] for name in cls.PRIMARY_KEYS)
+        csv_key = ''.join('%s, ' % expressions[name] for name in cls.PRIMARY_KEYS)
+        source = ('def convert_row(row):\n    return (\n%s\n    )\n\n'
+            'def row_key(values):\n    return (%s)\n\n'
+            'def row_object(values):\n    return {\n%s\n    }\n\n'
+            'def csv_key(row):\n    return (%s)\n'
+            % ('\n'.join(values), key, '\n'.join(items), csv_key))
+
+        namespace = {
+            'convert_date': cls.convert_date,
+            'convert_float': cls.convert_float,
+            'convert_int': cls.convert_int,
+        }
+        exec(compile(source, '<%s row functions>' % cls.__name__, 'exec'), namespace)
+        cls._row_functions = (namespace['convert_row'], namespace['row_key'],
+            namespace['row_object'], namespace['csv_key'])
+        return cls._row_functions
+
+
+    @classmethod
+    def convert_rows_columnar(cls, rows):
+        """Convert list of rows from CSV into list of tuples of values, same
+        as 'convert_row()' (see 'row_functions()') but column by column using
+        numpy/pandas."""
+
+        try:
+            table = numpy.array(rows, dtype=object)
+        except ValueError:
+            # rows of different length, give up and use the "row" way
+            convert_row = cls.row_functions()[0]
+            return [convert_row(row) for row in rows]
+
+        columns = []
+        for item in cls.STRUCTURE:
+            name = item['id']
+            column = table[:, item['csvindex']]
+            # the later wins, same as in 'row_functions()'
+            if name in cls.INT_ITEM_NAMES:
+                empty = column == ''
+                values = numpy.char.strip(column.astype(str), "'").astype(object)
+                values[empty] = None
+            elif name in cls.FLOAT_ITEM_NAMES:
+                empty = column == ''
+                text = numpy.char.replace(column.astype(str), ',', '.')
+                text[empty] = 'nan'
+                values = text.astype(float).astype(object)
+                values[empty] = None
+            elif name in cls.DATE_ITEM_NAMES:
+                # dates repeat a lot, so convert only distinct values
+                codes, uniques = pandas.factorize(column)
+                converted = numpy.array([cls.convert_date(value) for value in uniques],
+                    dtype=object)
+                values = converted.take(codes)
+            else:
+                values = column
+            columns.append(values.tolist())
+
+        return list(zip(*columns))
+
+
+    def read_rows(self, itemreader, csvreader, counter, stages=None):
+        """Read and convert rows from given CSV reader, 'counter' being number
+        of rows read before.
+
+        Yields tuples (row number, position after the row, tuple of values,
+        see 'row_functions()'). Position (offset after the row and digest of
+        the file up to that offset) is either 'csvreader' itself, valid only
+        until the next row is read, or 'FilePosition'.
+
+        Seconds spent reading and converting are added to 'read' and
+        'convert' items of 'stages' dict, if given."""
+
+        if self.conversion_engine == 'columnar':
+            yield from self.read_rows_columnar(itemreader, csvreader, counter, stages)
             return
 
-        # Push the records to the DataStore table
+        convert_row = self.row_functions()[0]
+        perf_counter = time.perf_counter
+        read = 0.0
+        convert = 0.0
+        try:
+            start = perf_counter()
+            for row in itemreader:
+                counter += 1
+                converting = perf_counter()
+                values = convert_row(row)
+                converted = perf_counter()
+                read += converting - start
+                convert += converted - converting
+                yield counter, csvreader, values
+                start = perf_counter()
+        finally:
+            if stages is not None:
+                stages['read'] = stages.get('read', 0.0) + read
+                stages['convert'] = stages.get('convert', 0.0) + convert
+
+
+    def read_rows_columnar(self, itemreader, csvreader, counter, stages=None):
+        """Same as 'read_rows()' but converts chunks of rows at once, see
+        'convert_rows_columnar()'."""
+
+        perf_counter = time.perf_counter
+        read = 0.0
+        convert = 0.0
+        rows = []
+        positions = []
+        try:
+            start = perf_counter()
+            for row in itemreader:
+                counter += 1
+                rows.append(row)
+                positions.append((counter, csvreader.position()))
+                if len(rows) >= COLUMNAR_CHUNK_ROWS:
+                    converting = perf_counter()
+                    converted = self.convert_rows_columnar(rows)
+                    read += converting - start
+                    convert += perf_counter() - converting
+                    for position, values in zip(positions, converted):
+                        yield position + (values,)
+                    rows = []
+                    positions = []
+                    start = perf_counter()
+
+            if len(rows) > 0:
+                converting = perf_counter()
+                converted = self.convert_rows_columnar(rows)
+                read += converting - start
+                convert += perf_counter() - converting
+                for position, values in zip(positions, converted):
+                    yield position + (values,)
+        finally:
+            if stages is not None:
+                stages['read'] = stages.get('read', 0.0) + read
+                stages['convert'] = stages.get('convert', 0.0) + convert
+
+
+    def row_key(self, record):
+        """Return value of primary key for given JSON record (dict), same as
+        'row_key()' from 'row_functions()' for tuple of values."""
+
+        return tuple(record[key] for key in self.PRIMARY_KEYS)
+
+
+    @staticmethod
+    def row_fingerprint(encoded_row):
+        """Return hash of given (converted and JSON encoded) row, used to detect
+        changed rows."""
+
+        return hashlib.blake2b(encoded_row, digest_size=16).digest()
+
+
+    def post_upsert(self, records, method='upsert'):
+        """Call 'datastore_upsert' with given records (encoded with
+        'encode_json()') and given method ('upsert' or 'insert').
+
+        Transient failures (connection errors, timeouts, HTTP 429 and 5xx) are
+        retried with jittered exponential backoff. Timeout also makes further
+        batches smaller (see 'BatchSizer.timed_out()'). Each request holds one
+        of upload slots shared by all datasets (if limited, see 'CkanClient'),
+        but not while waiting before a retry.
+
+        Returns response and duration of the request in seconds."""
+
         data = {
             'resource_id': self.resource_id,
-            'method': 'upsert',
-            'records': records,
+            'method': method,
+        }
+
+        payload = sum(len(record) + 1 for record in records)
+        slots = self.ckan.upload_slots
+        attempt = 0
+        timed_out = False
+        while True:
+            if slots is not None:
+                slots.acquire()
+            start = time.time()
+            try:
+                response = self.ckan.action('datastore_upsert', data, records)
+                elapsed = time.time() - start
+                self.upsert_metrics(payload, elapsed, attempt)
+                if response.status_code != 429 and response.status_code < 500:
+                    return response, elapsed
+                error = 'HTTP {0}: {1}'.format(response.status_code, response.content[:200])
+            except requests.exceptions.ConnectTimeout as e:
+                self.upsert_metrics(payload, time.time() - start, attempt)
+                error = str(e)
+            except requests.exceptions.Timeout as e:
+                self.upsert_metrics(payload, time.time() - start, attempt)
+                if not timed_out:
+                    self.batch_sizer.timed_out()
+                    timed_out = True
+                error = str(e)
+            except requests.exceptions.ConnectionError as e:
+                self.upsert_metrics(payload, time.time() - start, attempt)
+                error = str(e)
+            finally:
+                if slots is not None:
+                    slots.release()
+
+            attempt += 1
+            if attempt > self.upsert_retries:
+                exit('Error: datastore_upsert failed {0} times, last error: {1}'.format(
+                    attempt, error))
+            delay = random.uniform(0, self.upsert_backoff * 2 ** (attempt - 1))
+            print('warning: datastore_upsert failed (%s), retry %d in %.1f s'
+                % (error, attempt, delay))
+            if INTERRUPTED.wait(delay):
+                raise KeyboardInterrupt()
+
+
+    def reject(self, encoded_record, response):
+        """Store record (encoded with 'encode_json()') rejected by CKAN into
+        reject file."""
+
+        record = json.loads(encoded_record)
+        self.rejected += 1
+        # do not store the fingerprint, so that the record is tried again next
+        # time (see 'checkpoint()')
+        self.rejected_keys.add(self.row_key(record))
+
+        reject = {
+            'time': datetime.datetime.now().isoformat(),
+            'status': response.status_code,
+            'error': response.text,
+            'record': record,
         }
+        with REJECT_LOCK:
+            with open(REJECT_FILE % self.CONFIG_SECTION, 'a') as reject_file:
+                reject_file.write(json.dumps(reject) + '\n')
+
+        print('warning: record %s rejected with HTTP %d, see %s'
+            % (self.row_key(record), response.status_code, REJECT_FILE % self.CONFIG_SECTION))
+
+
+    def report_duplicates(self, csvfn, duplicates):
+        """Store duplicates found in given CSV file (list of tuples (key, row
+        number, row number of the previous row with the same key)) into
+        duplicate file. Row numbers count CSV records (the header being the
+        first one), not lines, as quoted values may span several lines.
+        Duplicates reported before (see 'Mirror.note_duplicates()') are not
+        reported again."""
+
+        duplicates = self.mirror.note_duplicates(os.path.basename(csvfn), duplicates)
+        if len(duplicates) == 0:
+            return
+        self.reported_duplicates += len(duplicates)
+
+        now = datetime.datetime.now().isoformat()
+        with open(DUPLICATE_FILE % self.CONFIG_SECTION, 'a') as duplicate_file:
+            for key, row, previous in duplicates:
+                duplicate = {
+                    'time': now,
+                    'file': csvfn,
+                    'key': key,
+                    'row': row,
+                    'previous_row': previous,
+                }
+                duplicate_file.write(json.dumps(duplicate) + '\n')
+
+
+    def upsert_metrics(self, payload, latency, attempt):
+        """Note 'datastore_upsert' call (of given payload size, taking given
+        seconds, 'attempt' being number of failed attempts before) in metrics."""
+
+        self.metrics.observe(self.metrics_file, latency)
+        self.metrics.add(self.metrics_file, 'upsert_calls', 1)
+        self.metrics.add(self.metrics_file, 'upsert_seconds', latency)
+        self.metrics.add(self.metrics_file, 'bytes_sent', payload)
+        if attempt > 0:
+            self.metrics.add(self.metrics_file, 'upsert_retries', 1)
+
+
+    def upsert(self, records, size=0, method='upsert'):
+        """Upsert (or insert, depending on 'method', see 'post_upsert()') given
+        records (encoded with 'encode_json()', of given estimated size in
+        bytes) into data store.
+
+        If the batch is too big for CKAN (rejected with HTTP 413), it is split
+        in half and both halves are pushed
+        separately. If the batch is rejected (e.g. due to invalid data), it is
+        bisected to find offending records, which are then stored aside (see
+        'reject()') while the rest gets pushed.
+
+        Insert of a batch rejected with HTTP 409 is repeated as upsert, as some
+        of its records may be already stored (CKAN committed the batch but the
+        response got lost and the request was retried, or an interrupted bulk
+        load gets resumed) and upsert of those is harmless. Only if the upsert
+        gets rejected too, the batch gets bisected."""
+
+        if len(records) == 0:
+            return
 
-        response = requests.post(
-            '{0}/api/action/datastore_upsert'.format(self.ckan_url),
-            data=json.dumps(data),
-            headers={'Content-type': 'application/json',
-                     'Authorization': self.api_key},
-            verify=self.ssl_verify)
+        # Push the records to the DataStore table
+        response, elapsed = self.post_upsert(records, method)
+
+        half = len(records) // 2
+        if response.status_code == 413:
+            if len(records) == 1:
+                exit('Error: single record too big to be pushed')
+            self.batch_sizer.too_big(size)
+            print('debug: batch of %d items too big, splitting' % len(records))
+            self.upsert(records[:half], size * half // len(records), method)
+            self.upsert(records[half:], size * (len(records) - half) // len(records), method)
+            return
+
+        if method == 'insert' and response.status_code == 409:
+            print('debug: insert of %d items conflicted, pushing them with upsert' % len(records))
+            self.upsert(records, size, 'upsert')
+            return
+
+        if 400 <= response.status_code < 500 and response.status_code not in FATAL_STATUS_CODES:
+            if len(records) == 1:
+                self.reject(records[0], response)
+                return
+            print('debug: batch of %d items rejected with HTTP %d, bisecting'
+                % (len(records), response.status_code))
+            self.upsert(records[:half], size * half // len(records), method)
+            self.upsert(records[half:], size * (len(records) - half) // len(records), method)
+            return
 
         if response.status_code != 200:
             exit('Error: {0}'.format(response.content))
 
+        self.batch_sizer.success(size, elapsed)
+        self.metrics.add(self.metrics_file, 'rows_pushed', len(records))
         print('debug: pushed %d items in a batch' % len(records))
 
 
-    def update_month(self, csvdate):
-        """
-        Basic update operation for one month (i.e. one CSV file).
+    def encode_rows(self, rows, stages=None):
+        """Encode rows (see 'read_rows()') into JSON.
 
-        csvdate: portion of CSV file name with year andf month (e.g. '2018-3')
+        Yields tuples (row number, position, primary key, encoded row,
+        fingerprint of the row), see 'read_rows()' for the first two.
 
-        Returns:
-        - True: file processed (and we may attempt file for next month)
-        - False: file not found (and thus it looks like we're done)
-        """
+        Seconds spent encoding are added to 'encode' item of 'stages' dict,
+        if given."""
 
-        # prepare mapping from structure and some helpers
-        # TODO: This is "static", i.e.  move it somewhere so that it runs
-        # only once, not "once for each CSV file".
-        mapping = {}
-        for item in self.STRUCTURE:
-            mapping[item['id']] = item['csvindex']
+        convert_row, row_key, row_object = self.row_functions()[:3]
+        perf_counter = time.perf_counter
+        encode = 0.0
+        try:
+            for counter, position, values in rows:
+                start = perf_counter()
+                encoded_row = encode_json(row_object(values))
+                fingerprint = self.row_fingerprint(encoded_row)
+                encode += perf_counter() - start
+                yield counter, position, row_key(values), encoded_row, fingerprint
+        finally:
+            if stages is not None:
+                stages['encode'] = stages.get('encode', 0.0) + encode
 
-        # some other hacks:
-        # - some EKS items aer too big, triggering "csv.Error: field larger than field limit"
-        csv.field_size_limit(262144)
 
-        # records to be inserted
-        records = []
-
-        # Load the CSV file
-        csvfn = os.path.join(self.directory_root, self.DIRECTORY_SUBDIR,
-            self.CSV_FN_PATTERN_2 % csvdate)
-        if not os.path.exists(csvfn):
-            print("file %s not available, it looks like we are done" % csvfn)
-            return False
+    def find_last_rows(self, csvfn):
+        """Read primary keys of all rows of given CSV file (without converting
+        the rest of the rows). Returns 'KeyIndex' with number of the last row
+        of each key (counted as in 'read_month()')."""
 
-        with open(csvfn, 'r') as csvfile:
-            print("loading %s ..." % csvfn)
-            itemreader = csv.reader(csvfile)
-            counter = 0
+        csv_key = self.row_functions()[3]
+        # see 'read_month()'
+        csv.field_size_limit(262144)
+        index = KeyIndex()
+        with open(csvfn, 'rb') as csvfile:
+            itemreader = csv.reader(CsvFileReader(csvfile))
+            counter = 1
+            if next(itemreader, None) is None:
+                return index
             for row in itemreader:
                 counter += 1
+                index.add(csv_key(row), counter)
+        return index
+
+
+    def batch_rows(self, month, rows):
+        """Skip rows (see 'encode_rows()') of given month (see 'plan_month()')
+        which did not change since they were pushed last time and group the
+        rest into batches limited by 'batch_sizer'.
+
+        Duplicates (rows with the same primary key as some previous row in
+        the file, e.g. ZoznamZakaziekReport_2018-3_.csv contains 'Z20187264'
+        at least three times) are reported (see 'report_duplicates()').
+        DataStore keeps only the last of those (due to 'upsert'). If the file
+        had duplicates when it was processed before, last rows of all keys
+        are found first (see 'find_last_rows()') and earlier rows with the
+        same key are skipped, so that only changed rows get pushed again.
+        Otherwise all of them are pushed, but if the previous one is still in
+        the batch, it gets replaced instead of pushing both.
+
+        Yields tuples (records, keys, size, marker) for
+        'BatchUploader.submit()', the last one (possibly empty) marking the end
+        of the rows (position after the last row, (row number, position), is
+        expected in month['end'] once all rows were read)."""
+
+        # records to be inserted, already encoded into JSON (with their primary
+        # keys, fingerprints and estimated size of JSON payload)
+        records = []
+        keys = []
+        fingerprints = []
+        size = 0
+        # positions of records in the batch by their keys
+        batch_keys = {}
+        mirror = self.open_mirror()
+        index = KeyIndex()
+        duplicates = []
+        last_rows = None
+        if mirror.has_duplicates(os.path.basename(month['csvfn'])):
+            last_rows = self.find_last_rows(month['csvfn'])
+
+        try:
+            for counter, position, key, encoded_row, row_fingerprint in rows:
+                if INTERRUPTED.is_set():
+                    raise KeyboardInterrupt()
+
+                previous = index.add(key, counter)
+                if previous is not None:
+                    self.duplicates += 1
+                    duplicates.append((key, counter, previous))
+                    if len(duplicates) >= 1000:
+                        self.report_duplicates(month['csvfn'], duplicates)
+                        duplicates = []
+
+                if last_rows is not None:
+                    last_row = last_rows.get(key)
+                    if last_row is not None and last_row > counter:
+                        # the same key follows later in the file, only the last
+                        # row gets pushed
+                        self.collapsed += 1
+                        continue
+                    check_mirror = True
+                else:
+                    # Push duplicates even if unchanged since the last time,
+                    # as the previous row (with the same key) may have been
+                    # pushed just now.
+                    check_mirror = previous is None
+                if check_mirror and mirror.fingerprint(key) == row_fingerprint:
+                    # skip rows which were already pushed and did not change since
+                    self.skipped += 1
+                    continue
 
-                if counter == 1:
-                    if not self.csv_header_check(row):
-                        exit('%s header check failed' % csvfn)
+                in_batch = batch_keys.get(key)
+                if in_batch is not None:
+                    self.collapsed += 1
+                    size += len(encoded_row) - len(records[in_batch])
+                    records[in_batch] = encoded_row
+                    fingerprints[in_batch] = row_fingerprint
                     continue
 
-                # convert row from CSV into JSON row
-                rowjson = {}
-                for mitem in mapping:
-                    rowjson[mitem] = row[mapping[mitem]]
-                # fix dates, floats, etc.:
-                for mitem in self.DATE_ITEM_NAMES:
-                    rowjson[mitem] = self.convert_date(row[mapping[mitem]])
-                for mitem in self.FLOAT_ITEM_NAMES:
-                    rowjson[mitem] = self.convert_float(row[mapping[mitem]])
-                for mitem in self.INT_ITEM_NAMES:
-                    rowjson[mitem] = self.convert_int(row[mapping[mitem]])
-
-                # TODO: add duplicate detection: For example
-                # ZoznamZakaziekReport_2018-3_.csv contains 'Z20187264' at least
-                # three time.  We push all accurences to 'records' here but
-                # DataStore (based on IdentifikatorZakazky labeled as 'id' and
-                # with 'upsert') overwrites first occurence with seconds, etc.
-                # so at the end only last item gets actually stored.
-                # It not clear what to do with that but at least we should
-                # detect duplicates and reports their line numbers in a
-                # dedicated "problems" column?
-
-                # TODO: use the ID to obtain the row also from CKAN, so that we
-                # can properly create "created" and "modified" timestamps
-
-                records.append(rowjson)
+                batch_keys[key] = len(records)
+                records.append(encoded_row)
+                keys.append(key)
+                fingerprints.append(row_fingerprint)
+                size += len(encoded_row) + 1
 
                 # batching, to avoid pushing too much in one call
-                if len(records) >= BATCH_SIZE:
-                    self.upsert(records)
+                if self.batch_sizer.is_full(len(records), size):
+                    yield records, keys, size, (position.offset, counter - 1, position.hexdigest(),
+                        records, keys, fingerprints)
                     records = []
+                    keys = []
+                    fingerprints = []
+                    size = 0
+                    batch_keys = {}
+
+            # remaining records
+            counter, position = month['end']
+            yield records, keys, size, (position.offset, counter - 1, position.hexdigest(),
+                records, keys, fingerprints)
+        finally:
+            index.close()
+            if last_rows is not None:
+                last_rows.close()
+            self.report_duplicates(month['csvfn'], duplicates)
+
+
+    def store_pushed(self, records, keys, fingerprints):
+        """Store given pushed records (with given keys and fingerprints) into
+        the mirror, except those rejected by CKAN. Returns number of stored
+        records.
+
+        Rejected records are not stored, so that those are tried again when
+        the file is processed again (the last processed one is, on next
+        update, see also 'push_month()')."""
+
+        if len(self.rejected_keys) > 0:
+            pushed = [i for i, key in enumerate(keys) if key not in self.rejected_keys]
+            records = [records[i] for i in pushed]
+            keys = [keys[i] for i in pushed]
+            fingerprints = [fingerprints[i] for i in pushed]
+        self.mirror.store(keys, fingerprints, records)
+        return len(keys)
+
+
+    def checkpoint(self, csvdate, offset, rows, digest, records, keys, fingerprints):
+        """Note that first 'rows' rows of given CSV file (up to given byte
+        offset, with given digest of that part of the file) were pushed,
+        including given records with given keys and fingerprints.
+
+        Called (in order) for each pushed batch, see 'BatchUploader'. This way
+        we can resume from the last pushed batch after a crash, instead of
+        starting the whole file from the beginning."""
+
+        self.store_pushed(records, keys, fingerprints)
+
+        self.state[STATE_CHECKPOINT + self.CONFIG_SECTION] = {
+            'csvdate': csvdate,
+            'offset': offset,
+            'rows': rows,
+            'digest': digest,
+        }
+        self.save_state()
+
+
+    def month_updater(self, csvdate):
+        """Return updater (instance of this or other class, sharing state) to
+        be used for given month, see 'ZakazkyAZmluvy' for example."""
+
+        return self
+
+
+    def plan_month(self, csvdate):
+        """Find out what has to be done with given month (i.e. one CSV file).
+
+        csvdate: portion of CSV file name with year andf month (e.g. '2018-3')
 
+        Returns None if the file was not found, otherwise dict with CSV file name, its stat, part of the file
+        processed before and not to be processed again ('resume', or None)
+        and whether the file can be skipped altogether ('skip', if it did not
+        change since it was processed last time)."""
 
-        # upsert remaining records, mark state
-        self.upsert(records)
+        csv_file = self.list_csv_files().get(csvdate)
+        if csv_file is None:
+            print("file for %s not available" % csvdate)
+            return None
+        csvfn, csvstat = csv_file
+
+        month = {
+            'csvdate': csvdate,
+            'csvfn': csvfn,
+            'csvstat': csvstat,
+            'resume': None,
+            'skip': False,
+        }
+
+        checkpoint = self.state.get(STATE_CHECKPOINT + self.CONFIG_SECTION)
+        if checkpoint is not None and checkpoint['csvdate'] != csvdate:
+            checkpoint = None
+
+        # Skip the file if it did not change since it was processed last time.
+        file_info = self.state.get(STATE_FILE_INFO + self.CONFIG_SECTION, {}).get(csvdate)
+        if checkpoint is None and file_info is not None and file_info['size'] == csvstat.st_size:
+            unchanged = file_info['mtime'] == csvstat.st_mtime_ns
+            if not unchanged:
+                # modified (or just touched), check the content
+                unchanged = CsvFileReader.file_digest(csvfn) == file_info['digest']
+                if unchanged:
+                    file_info['mtime'] = csvstat.st_mtime_ns
+                    self.save_state()
+            if unchanged:
+                print("file %s did not change since last update, skipping" % csvfn)
+                month['skip'] = True
+                return month
+
+        # Resume from checkpoint, if we crashed in the middle of this file
+        # previously. Otherwise, if the file was processed before and then
+        # new rows were just appended to it ("tail mode"), process only the
+        # appended rows. In both cases, part of the file processed before
+        # must not have changed.
+        resume = None
+        if checkpoint is not None:
+            resume = checkpoint
+        elif file_info is not None and file_info.get('tail'):
+            resume = {
+                'offset': file_info['size'],
+                'rows': file_info['rows'],
+                'digest': file_info['digest'],
+            }
+        if resume is not None and (resume['offset'] > csvstat.st_size
+                or CsvFileReader.file_digest(csvfn, resume['offset']) != resume['digest']):
+            print("file %s changed since last update, processing whole file" % csvfn)
+            resume = None
+        month['resume'] = resume
+
+        return month
+
+
+    def read_month(self, month, verbose=True):
+        """Read rows of given month (see 'plan_month()') from CSV file,
+        converted and encoded (see 'encode_rows()'). Progress is printed only
+        if 'verbose' (not in worker processes, see 'read_spool()').
+
+        When done, position after the last row ('end', see 'batch_rows()')
+        and info about the file ('info', to be stored in the state) are added
+        to 'month'. Seconds spent in stages of processing ('stages', see
+        'read_rows()' and 'encode_rows()') are added right away."""
+
+        # some other hacks:
+        # - some EKS items aer too big, triggering "csv.Error: field larger than field limit"
+        csv.field_size_limit(262144)
+
+        csvfn = month['csvfn']
+        resume = month['resume']
+        with open(csvfn, 'rb') as csvfile:
+            if verbose:
+                print("loading %s ..." % csvfn)
+            csvreader = CsvFileReader(csvfile)
+            itemreader = csv.reader(csvreader)
+            counter = 0
+
+            header = next(itemreader, None)
+            if header is not None:
+                counter = 1
+                if not self.csv_header_check(header):
+                    exit('%s header check failed' % csvfn)
+                if resume is not None:
+                    if verbose:
+                        print("resuming from row %d (offset %d)"
+                            % (resume['rows'], resume['offset']))
+                    csvreader.skip_to(resume['offset'])
+                    counter += resume['rows']
+
+            # stream of rows read from the CSV file, converted and encoded, so
+            # that (apart from the batches, see 'batch_rows()') no more than
+            # a few rows are kept in memory
+            stages = month['stages'] = {'read': 0.0, 'convert': 0.0, 'encode': 0.0}
+            rows = self.read_rows(itemreader, csvreader, counter, stages)
+            for row in self.encode_rows(rows, stages):
+                counter = row[0]
+                yield row
+
+        month['end'] = (counter, csvreader)
+        month['info'] = {
+            # size is taken from what we have actually read, in case file was
+            # modified meanwhile
+            'size': csvreader.offset,
+            'mtime': month['csvstat'].st_mtime_ns,
+            'digest': csvreader.hexdigest(),
+            'rows': counter - 1,
+            # appended rows can be processed separately only if we did not
+            # end in the middle of a line
+            'tail': csvreader.complete_line,
+        }
+
+
+    def read_spool(self, month, spool_fn):
+        """Read rows of given month stored into given spool file by
+        'spool_month()', same as 'read_month()' would do. Spool file is removed
+        afterwards."""
+
+        print("loading %s (read ahead) ..." % month['csvfn'])
+        resume = month['resume']
+        if resume is not None:
+            print("resuming from row %d (offset %d)" % (resume['rows'], resume['offset']))
+        try:
+            with open(spool_fn, 'rb') as spool:
+                while True:
+                    try:
+                        chunk = pickle.load(spool)
+                    except EOFError:
+                        break
+                    for counter, offset, digest, key, encoded_row, fingerprint in chunk:
+                        yield (counter, FilePosition(offset, SpooledDigest(digest)), key,
+                            encoded_row, fingerprint)
+        finally:
+            os.remove(spool_fn)
+
+
+    def read_months(self, months):
+        """Read rows of given months (list of tuples (updater, month), see
+        'month_updater()' and 'plan_month()').
+
+        Yields tuples (updater, month, rows) in order of the months. With
+        more 'parse_workers', months are read (parsed, converted and encoded,
+        which is CPU bound) ahead in parallel by worker processes, while
+        (ordered) rows of the earlier months are being pushed."""
+
+        if self.parse_workers == 1 or len(months) < 2:
+            for updater, month in months:
+                yield updater, month, updater.read_month(month)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        executor = concurrent.futures.ProcessPoolExecutor(self.parse_workers, mp_context=context)
+        # months being read, not more than needed to keep all workers busy (as
+        # each of them takes disk space)
+        pending = collections.deque()
+        to_read = iter(months)
+        try:
+            for updater, month in to_read:
+                pending.append((updater, month,
+                    executor.submit(spool_month, type(updater), month)))
+                if len(pending) >= 2 * self.parse_workers:
+                    break
+
+            while len(pending) > 0:
+                updater, month, future = pending.popleft()
+                spool_fn, end, info, stages = future.result()
+                for next_updater, next_month in to_read:
+                    pending.append((next_updater, next_month,
+                        executor.submit(spool_month, type(next_updater), next_month)))
+                    break
+
+                counter, offset, digest = end
+                month['end'] = (counter, FilePosition(offset, SpooledDigest(digest)))
+                month['info'] = info
+                month['stages'] = stages
+                yield updater, month, updater.read_spool(month, spool_fn)
+        finally:
+            # remove spool files of months which were not pushed (due to
+            # failure)
+            for updater, month, future in pending:
+                if not future.cancel() and future.exception() is None:
+                    os.remove(future.result()[0])
+            executor.shutdown()
+
+
+    def push_month(self, month, rows):
+        """Push given rows (see 'read_month()') of given month into datastore
+        and mark the month as processed."""
+
+        csvdate = month['csvdate']
+        self.skipped = 0
+        self.duplicates = 0
+        self.reported_duplicates = 0
+        self.collapsed = 0
+        self.rejected = 0
+        self.rejected_keys = set()
+        self.metrics_file = os.path.basename(month['csvfn'])
+        start = time.time()
+
+        uploader = BatchUploader(self.upsert, self.upload_workers, self.upload_queue_size,
+            lambda marker: self.checkpoint(csvdate, *marker))
+        try:
+            for records, keys, size, marker in self.batch_rows(month, rows):
+                uploader.submit(records, keys, size, marker)
+        finally:
+            # wait for uploads to finish (also when parsing failed, to not
+            # leave uploads running in background)
+            uploader.close()
+
+        # mark state
         self.state[STATE_LAST_PROCESSED + self.CONFIG_SECTION] = csvdate
+        self.state.pop(STATE_CHECKPOINT + self.CONFIG_SECTION, None)
+        # file with rejected records is not marked as unchanged, so that it is
+        # not skipped and the records are tried again next time
+        file_info = self.state.setdefault(STATE_FILE_INFO + self.CONFIG_SECTION, {})
+        if self.rejected == 0:
+            file_info[csvdate] = month['info']
+        else:
+            file_info.pop(csvdate, None)
         self.save_state()
 
-        print("DataStore resource '{1}' successfully updated with {0} records.".format(
-            (counter - 1), self.CONFIG_SECTION))
+        resumed = 0 if month['resume'] is None else month['resume']['rows']
+        self.month_metrics(month, time.time() - start)
+        print("DataStore resource '{1}' successfully updated with {0} records ({2} unchanged skipped, {3} duplicates, {4} rejected).".format(
+            (month['info']['rows'] - resumed - self.skipped - self.collapsed - self.rejected),
+            self.CONFIG_SECTION, self.skipped, self.duplicates, self.rejected))
+        if self.reported_duplicates > 0:
+            print('warning: %d new duplicates found in %s, see %s'
+                % (self.reported_duplicates, month['csvfn'], DUPLICATE_FILE % self.CONFIG_SECTION))
+
+
+    def update_month(self, csvdate):
+        """
+        Basic update operation for one month (i.e. one CSV file).
+
+        csvdate: portion of CSV file name with year andf month (e.g. '2018-3')
+
+        Returns:
+        - True: file processed
+        - False: file not found
+        """
 
+        month = self.plan_month(csvdate)
+        if month is None:
+            return False
+        if not month['skip']:
+            self.push_month(month, self.read_month(month))
         return True
 
 
     def update(self):
-        """Basic update operation called from command line."""
+        """Basic update operation called from command line.
+
+        Returns number of processed files."""
 
         # Load "state" (YYYY-M of last processed file); if not then
         self.load_state()
@@ -454,6 +2534,9 @@ resource_id={1}
             month_to_process = self.state[state_key]
         if month_to_process is None:
             month_to_process = self.find_oldest_csvdate()
+            if month_to_process is None:
+                print("no CSV files found, nothing to do")
+                return 0
 
         # process "last processed" month assuming:
         # 1) if it is still "current month": we will process all, pick
@@ -463,14 +2546,268 @@ resource_id={1}
         # picking up latest updates and then proceed to the next (i.e.
         # current) month
         counter = 0
-        while self.update_month(month_to_process):
-            counter += 1
-            # OK, get the name for "next month" and try it ...
-            month_to_process = self.next_csvdate(month_to_process)
+        if self.parse_workers > 1:
+            # Find out which months are to be processed first, so that those
+            # can be read in parallel, see 'read_months()'. Months are still
+            # pushed (and marked as processed in the state) in order.
+            months = []
+            for csvdate in self.csvdates_from(month_to_process):
+                updater = self.month_updater(csvdate)
+                month = updater.plan_month(csvdate)
+                counter += 1
+                if not month['skip']:
+                    months.append((updater, month))
+
+            for updater, month, rows in self.read_months(months):
+                updater.push_month(month, rows)
+        else:
+            for csvdate in self.csvdates_from(month_to_process):
+                self.month_updater(csvdate).update_month(csvdate)
+                counter += 1
+
+        self.close_mirror()
 
         print('%d files processed.' % counter)
 
-        return
+        return counter
+
+
+    def month_metrics(self, month, seconds):
+        """Note given month (read, see 'read_month()', and pushed or staged
+        in given number of seconds) in metrics."""
+
+        filename = os.path.basename(month['csvfn'])
+        resumed = 0 if month['resume'] is None else month['resume']['rows']
+        self.metrics.add(filename, 'rows_read', month['info']['rows'] - resumed)
+        self.metrics.add(filename, 'rows_skipped', self.skipped)
+        self.metrics.add(filename, 'rows_duplicate', self.duplicates)
+        self.metrics.add(filename, 'rows_rejected', self.rejected)
+        for stage, stage_seconds in month['stages'].items():
+            self.metrics.add(filename, stage + '_seconds', stage_seconds)
+        self.metrics.add(filename, 'seconds', seconds)
+
+
+    def write_metrics(self, seconds, files, rss, success):
+        """Write metrics of this run (which took given number of seconds,
+        processed given number of files, peak RSS or None and whether it
+        succeeded) into 'metrics_dir', if configured: in Prometheus text
+        format (for node exporter's textfile collector) and as JSON summary.
+
+        Counters are per CSV file (in 'file' label, empty for inserts done
+        by 'bulk_load()' after rows were merged) and cover only this run."""
+
+        if not self.metrics_dir:
+            return
+
+        summary = self.metrics.summary()
+        dataset = self.CONFIG_SECTION
+        lines = []
+
+        def format_labels(labels):
+            return ','.join('%s="%s"' % (label, value.replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n')) for label, value in labels)
+
+        def metric(name, kind, description, samples):
+            lines.append('# HELP eks_datastore_%s %s' % (name, description))
+            lines.append('# TYPE eks_datastore_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('eks_datastore_%s{%s} %r' % (name, format_labels(labels),
+                    float(value)))
+
+        dataset_labels = (('dataset', dataset),)
+        metric('last_run_timestamp_seconds', 'gauge', 'Time the last run finished.',
+            [(dataset_labels, time.time())])
+        metric('last_run_success', 'gauge', 'Whether the last run succeeded.',
+            [(dataset_labels, 1 if success else 0)])
+        metric('last_run_seconds', 'gauge', 'Duration of the last run.',
+            [(dataset_labels, seconds)])
+        metric('last_run_files', 'gauge', 'CSV files processed in the last run.',
+            [(dataset_labels, files)])
+        if rss is not None:
+            metric('last_run_peak_rss_bytes', 'gauge', 'Peak RSS of the last run.',
+                [(dataset_labels, rss)])
+
+        counters = (
+            ('rows_read', 'Rows read from CSV file'),
+            ('rows_pushed', 'Rows pushed into DataStore'),
+            ('rows_skipped', 'Rows skipped as unchanged'),
+            ('rows_duplicate', 'Rows with primary key seen before in the same file'),
+            ('rows_rejected', 'Rows rejected by CKAN'),
+            ('bytes_sent', 'Bytes of JSON records sent to CKAN'),
+            ('upsert_calls', 'Calls of datastore_upsert'),
+            ('upsert_retries', 'Retried calls of datastore_upsert'),
+            ('rows_per_second', 'Rows read per second (whole processing of the file)'),
+        )
+        for name, description in counters:
+            metric('last_run_' + name, 'gauge', description + ' (last run).',
+                [(dataset_labels + (('file', filename),), item.get(name, 0))
+                    for filename, item in summary.items()])
+
+        stages = ('read', 'convert', 'encode', 'upsert')
+        metric('last_run_stage_seconds', 'gauge',
+            'Seconds spent in stages of processing (last run, summed over threads and processes).',
+            [(dataset_labels + (('file', filename), ('stage', stage)),
+                item.get(stage + '_seconds', 0))
+                for filename, item in summary.items() for stage in stages])
+
+        name = 'eks_datastore_last_run_upsert_duration_seconds'
+        lines.append('# HELP %s Latency of datastore_upsert calls (last run).' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for filename in summary:
+            buckets, total, count = self.metrics.histogram(filename)
+            labels = format_labels(dataset_labels + (('file', filename),))
+            for bound, bucket_count in buckets:
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, bucket_count))
+            lines.append('%s_sum{%s} %r' % (name, labels, total))
+            lines.append('%s_count{%s} %d' % (name, labels, count))
+
+        basename = os.path.join(self.metrics_dir, 'datastore_updater.%s' % dataset)
+        write_atomically(basename + '.prom', '\n'.join(lines) + '\n')
+        write_atomically(basename + '.json', json.dumps({
+            'dataset': dataset,
+            'time': datetime.datetime.now().isoformat(),
+            'success': success,
+            'seconds': seconds,
+            'files': files,
+            'peak_rss': rss,
+            'per_file': summary,
+        }, indent=2) + '\n')
+
+
+    def stage_month(self, month, rows):
+        """Store given rows (see 'read_month()') of given month into staging
+        table of the mirror, see 'bulk_load()'."""
+
+        start = time.time()
+        mirror = self.open_mirror()
+        staged = []
+        for counter, position, key, encoded_row, fingerprint in rows:
+            if INTERRUPTED.is_set():
+                raise KeyboardInterrupt()
+            staged.append((encode_json(key), fingerprint, encoded_row))
+            if len(staged) >= STAGE_ROWS:
+                mirror.stage(staged)
+                staged = []
+        mirror.stage(staged)
+        self.month_metrics(month, time.time() - start)
+
+
+    def bulk_checkpoint(self, size, records, keys, fingerprints):
+        """Note that given records (with given keys, fingerprints and size of
+        payload) were inserted by 'bulk_load()' and report progress."""
+
+        progress = self.bulk_progress
+        progress['rows'] += self.store_pushed(records, keys, fingerprints)
+        progress['bytes'] += size
+        elapsed = time.time() - progress['start']
+        print('debug: %d of %d rows loaded (%.0f rows/s, %.1f MiB/s)' % (progress['rows'],
+            progress['total'], progress['rows'] / elapsed, progress['bytes'] / elapsed / 1024 / 1024))
+
+
+    def bulk_load(self):
+        """Bulk load operation called from command line.
+
+        Loads all months into new (empty) DataStore resource at once: rows
+        from all CSV files are merged in staging table of the mirror first
+        (rows from later months replacing rows with the same primary key from
+        earlier ones) and then inserted (no need to 'upsert' into empty
+        resource) in big batches. State is then set so that 'update()'
+        continues with the last month.
+
+        If interrupted, it can be started again and it continues with rows
+        not inserted yet. Rows already in the mirror (e.g. pushed by an
+        interrupted update) are inserted only if they differ, their batches
+        then get upserted (see 'upsert()').
+
+        Returns number of processed files."""
+
+        self.load_state()
+        bulk_key = STATE_BULK_LOAD + self.CONFIG_SECTION
+        if STATE_LAST_PROCESSED + self.CONFIG_SECTION in self.state \
+                and not self.state.get(bulk_key):
+            exit('Error: %s was already updated, bulk-load works only for new (empty) resources'
+                % self.CONFIG_SECTION)
+        self.state[bulk_key] = True
+        self.save_state()
+
+        # merge all months
+        start = time.time()
+        mirror = self.open_mirror()
+        mirror.start_staging()
+        months = []
+        for csvdate in self.list_csv_files():
+            updater = self.month_updater(csvdate)
+            month = updater.plan_month(csvdate)
+            # whole files, even if processed before
+            month['resume'] = None
+            months.append((updater, month))
+
+        file_info = {}
+        last_csvdate = None
+        for updater, month, rows in self.read_months(months):
+            updater.stage_month(month, rows)
+            file_info[month['csvdate']] = month['info']
+            last_csvdate = month['csvdate']
+        total = mirror.staged_count()
+        print('%d rows from %d files staged in %.1f s' % (total, len(file_info),
+            time.time() - start))
+
+        # insert them in batches bigger than usual
+        batch_sizer = self.batch_sizer
+        self.batch_sizer = BatchSizer(BULK_BATCH_SIZE, BULK_BATCH_BYTES, batch_sizer.min_bytes,
+            batch_sizer.max_bytes, batch_sizer.latency)
+        self.batch_sizer.limit_bytes(batch_sizer.max_bytes)
+        self.rejected = 0
+        self.rejected_keys = set()
+        self.bulk_progress = {'total': total, 'rows': 0, 'bytes': 0, 'start': time.time()}
+        uploader = BatchUploader(lambda records, size: self.upsert(records, size, 'insert'),
+            self.upload_workers, self.upload_queue_size,
+            lambda marker: self.bulk_checkpoint(*marker))
+        try:
+            records = []
+            keys = []
+            fingerprints = []
+            size = 0
+            for key, fingerprint, record in mirror.staged_rows():
+                records.append(record)
+                keys.append(key)
+                fingerprints.append(fingerprint)
+                size += len(record) + 1
+                if self.batch_sizer.is_full(len(records), size):
+                    uploader.submit(records, keys, size, (size, records, keys, fingerprints))
+                    records = []
+                    keys = []
+                    fingerprints = []
+                    size = 0
+            uploader.submit(records, keys, size, (size, records, keys, fingerprints))
+        finally:
+            uploader.close()
+            self.batch_sizer = batch_sizer
+        self.metrics.add('', 'rows_read', total)
+        self.metrics.add('', 'rows_rejected', self.rejected)
+        self.metrics.add('', 'seconds', time.time() - self.bulk_progress['start'])
+
+        mirror.finish_staging()
+        self.close_mirror()
+
+        # regular update continues with the last month (skipping files which
+        # did not change meanwhile)
+        if last_csvdate is not None:
+            self.state[STATE_LAST_PROCESSED + self.CONFIG_SECTION] = last_csvdate
+            if self.rejected > 0:
+                # try rejected records of the last month again, see 'push_month()'
+                file_info.pop(last_csvdate, None)
+        self.state[STATE_FILE_INFO + self.CONFIG_SECTION] = file_info
+        self.state.pop(STATE_CHECKPOINT + self.CONFIG_SECTION, None)
+        self.state.pop(bulk_key)
+        self.save_state()
+
+        elapsed = time.time() - start
+        print("DataStore resource '%s' successfully loaded with %d records (%d rejected) "
+            "in %.1f s (%.0f rows/s)." % (self.CONFIG_SECTION, self.bulk_progress['rows'],
+            self.rejected, elapsed, self.bulk_progress['rows'] / elapsed))
+
+        return len(file_info)
 
 
 class AukcnePonuky(EksBaseDatastoreUpdater):
@@ -478,7 +2815,6 @@ class AukcnePonuky(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'aukcne_ponuky'
     DIRECTORY_SUBDIR = 'aukcne_ponuky'
-    CSV_FN_PATTERN = 'ZoznamAukcnychPonukReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamAukcnychPonukReport_%s_.csv'
 
     PRIMARY_KEYS = ['VerejnyIdentifikatorZakazky', 'DatumPredlozeniaPonuky']
@@ -528,7 +2864,6 @@ class KontrakracnePonuky(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'kontraktacne_ponuky'
     DIRECTORY_SUBDIR = 'kontraktacne_ponuky'
-    CSV_FN_PATTERN = 'ZoznamKontraktacnychPonukReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamKontraktacnychPonukReport_%s_.csv'
 
     PRIMARY_KEYS = ['VerejnyIdentifikatorZakazky', 'DatumPredlozeniaPonuky']
@@ -575,7 +2910,6 @@ class OpisneFormulare(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'opisne_formulare'
     DIRECTORY_SUBDIR = 'opisne_formulare'
-    CSV_FN_PATTERN = 'ZoznamOpisnychFormularovReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamOpisnychFormularovReport_%s_.csv'
 
     PRIMARY_KEYS = ['OpisnyFormularIdentifikator']
@@ -622,7 +2956,6 @@ class Referencie(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'referencie'
     DIRECTORY_SUBDIR = 'referencie'
-    CSV_FN_PATTERN = 'ZoznamReferenciiReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamReferenciiReport_%s_.csv'
 
     PRIMARY_KEYS = ['IdentifikatorZakazky']
@@ -666,7 +2999,6 @@ class Zakazky(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'zakazky'
     DIRECTORY_SUBDIR = 'zakazky'
-    CSV_FN_PATTERN = 'ZoznamZakaziekReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamZakaziekReport_%s_.csv'
 
     PRIMARY_KEYS = ['IdentifikatorZakazky']
@@ -841,7 +3173,6 @@ class ZakazkyAZmluvyOld(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'zakazky_a_zmluvy'
     DIRECTORY_SUBDIR = 'zakazky_a_zmluvy'
-    CSV_FN_PATTERN = 'ZoznamZakazkyZmluvyReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamZakazkyZmluvyReport_%s_.csv'
 
     PRIMARY_KEYS = ['IdentifikatorZakazky']
@@ -1060,7 +3391,6 @@ class ZakazkyAZmluvy(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'zakazky_a_zmluvy'
     DIRECTORY_SUBDIR = 'zakazky_a_zmluvy'
-    CSV_FN_PATTERN = 'ZoznamZakazkyZmluvyReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamZakazkyZmluvyReport_%s_.csv'
 
     PRIMARY_KEYS = ['IdentifikatorZakazky']
@@ -1278,7 +3608,7 @@ class ZakazkyAZmluvy(EksBaseDatastoreUpdater):
         'IdStavVCrz']
 
 
-    def update_month(self, csvdate):
+    def month_updater(self, csvdate):
         """Overidden to handle transition from old (up to 2018-9) to new structure
         (2018-10 and after). Quite ugly.
 
@@ -1286,16 +3616,18 @@ class ZakazkyAZmluvy(EksBaseDatastoreUpdater):
 
         update_date = datetime.datetime.strptime(csvdate, '%Y-%m')
         cutoff_date = datetime.datetime(2018, 10, 1)
-        result = None
         if cutoff_date <= update_date:
             # new structure => process withy this class
-            result = super().update_month(csvdate)
-        else:
-            # old structure => use old version of this class
-            old = ZakazkyAZmluvyOld()
-            result = old.update_month(csvdate)
+            return self
 
-        return result
+        # old structure => use old version of this class
+        old = ZakazkyAZmluvyOld()
+        old.state = self.state
+        old.csv_files = self.list_csv_files()
+        old.metrics = self.metrics
+        old.batch_sizer = self.batch_sizer
+        old.mirror = self.open_mirror()
+        return old
 
 
 class ZmluvyOld(EksBaseDatastoreUpdater):
@@ -1305,7 +3637,6 @@ class ZmluvyOld(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'zmluvy'
     DIRECTORY_SUBDIR = 'zmluvy'
-    CSV_FN_PATTERN = 'ZoznamZmluvReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamZmluvReport_%s_.csv'
 
     PRIMARY_KEYS = ['IdentifikatorZakazky']
@@ -1426,7 +3757,6 @@ class Zmluvy(EksBaseDatastoreUpdater):
 
     CONFIG_SECTION = 'zmluvy'
     DIRECTORY_SUBDIR = 'zmluvy'
-    CSV_FN_PATTERN = 'ZoznamZmluvReport_%Y-%m_.csv'
     CSV_FN_PATTERN_2 = 'ZoznamZmluvReport_%s_.csv'
 
     PRIMARY_KEYS = ['IdentifikatorZakazky']
@@ -1545,7 +3875,7 @@ class Zmluvy(EksBaseDatastoreUpdater):
     INT_ITEM_NAMES = ['IdStavVCrz']
 
 
-    def update_month(self, csvdate):
+    def month_updater(self, csvdate):
         """Overidden to handle transition from old (up to 2018-9) to new structure
         (2018-10 and after). Quite ugly.
 
@@ -1553,33 +3883,128 @@ class Zmluvy(EksBaseDatastoreUpdater):
 
         update_date = datetime.datetime.strptime(csvdate, '%Y-%m')
         cutoff_date = datetime.datetime(2018, 10, 1)
-        result = None
         if cutoff_date <= update_date:
             # new structure => process withy this class
-            result = super().update_month(csvdate)
+            return self
+
+        # old structure => use old version of this class
+        old = ZmluvyOld()
+        old.state = self.state
+        old.csv_files = self.list_csv_files()
+        old.metrics = self.metrics
+        old.batch_sizer = self.batch_sizer
+        old.mirror = self.open_mirror()
+        return old
+
+
+def reset_peak_rss():
+    """Reset peak resident set size of this process, if possible (Linux only,
+    elsewhere 'peak_rss()' gives peak of the whole run)."""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return peak resident set size of this process (in bytes) since the
+    last 'reset_peak_rss()', or None if not known."""
+
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def update_dataset(dataset, reset_rss=False, bulk_load=False):
+    """Update (or bulk load, see 'bulk_load()') one dataset, returns number
+    of processed files, time spent and peak RSS (see 'peak_rss()') when done.
+
+    With 'reset_rss', peak RSS is reset first (so that it is peak of this
+    dataset only, which makes sense only if datasets are not updated in
+    parallel)."""
+
+    if reset_rss:
+        reset_peak_rss()
+    start = time.time()
+    counter = 0
+    success = False
+    try:
+        if bulk_load:
+            counter = dataset.bulk_load()
         else:
-            # old structure => use old version of this class
-            old = ZmluvyOld()
-            result = old.update_month(csvdate)
+            counter = dataset.update()
+        success = True
+    finally:
+        dataset.write_metrics(time.time() - start, counter, peak_rss(), success)
+    return counter, time.time() - start, peak_rss()
 
-        return result
 
+def update_datasets(eks_datasets, jobs, bulk_load=False):
+    """Update (or bulk load) given datasets, up to 'jobs' of them in parallel.
 
-def help():
-    print('use \'setup\' or \'update\' parameter')
+    Failure of one dataset does not stop update of the others. Returns True
+    if all datasets were updated successfully.
 
+    On interrupt (Ctrl-C, received by the main thread), datasets not started
+    yet are cancelled and the running ones stop after the requests in
+    flight (see 'INTERRUPTED'), then KeyboardInterrupt is re-raised."""
 
-if __name__ == '__main__':
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for dataset in eks_datasets:
+            futures[executor.submit(update_dataset, dataset, jobs == 1, bulk_load)] = dataset
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                dataset = futures[future]
+                try:
+                    results[dataset.CONFIG_SECTION] = future.result()
+                except (Exception, SystemExit) as e:
+                    print('error: %s of %s failed: %s' % ('bulk-load' if bulk_load else 'update',
+                        dataset.CONFIG_SECTION, e))
+                    results[dataset.CONFIG_SECTION] = None
+        except KeyboardInterrupt:
+            print('warning: interrupted, waiting for requests in flight')
+            INTERRUPTED.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    print('summary:')
+    for dataset in eks_datasets:
+        result = results[dataset.CONFIG_SECTION]
+        if result is None:
+            print('  %-20s FAILED' % dataset.CONFIG_SECTION)
+        else:
+            rss = ''
+            if result[2] is not None:
+                rss = ', peak RSS %.1f MiB' % (result[2] / 1024 / 1024)
+            print('  %-20s %3d files processed in %.1f s%s' % (dataset.CONFIG_SECTION,
+                result[0], result[1], rss))
+
+    return None not in results.values()
 
-    if len(sys.argv) < 2:
-        help()
-        exit()
 
-    action = sys.argv[1]
+if __name__ == '__main__':
 
-    if action not in ('setup', 'update',):
-        help()
-        exit()
+    parser = argparse.ArgumentParser(usage=USAGE)
+    parser.add_argument('action', choices=('setup', 'update', 'bulk-load',))
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of datasets updated in parallel')
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs has to be at least 1')
 
     eks_datasets = [
         AukcnePonuky(),
@@ -1591,9 +4016,18 @@ if __name__ == '__main__':
         Zmluvy()
     ]
 
-    if action == 'setup':
-        for dataset in eks_datasets:
-            dataset.setup()
-    elif action == 'update':
-        for dataset in eks_datasets:
-            dataset.update()
+    result = True
+    try:
+        if args.action == 'setup':
+            for dataset in eks_datasets:
+                dataset.setup()
+        elif args.action == 'update':
+            result = update_datasets(eks_datasets, args.jobs)
+        elif args.action == 'bulk-load':
+            result = update_datasets(eks_datasets, args.jobs, bulk_load=True)
+    except KeyboardInterrupt:
+        exit('Interrupted')
+
+    CkanClient.print_all_stats()
+    if not result:
+        sys.exit(1)
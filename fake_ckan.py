@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018, Peter Hanecak <hanecak@opendata.sk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Fake CKAN with just the API actions used by 'datastore_updater.py'
+('package_create', 'datastore_create' and 'datastore_upsert'), keeping
+DataStore resources in memory.
+
+Meant for measuring and testing of the upload path locally (see 'e2e' in
+'benchmark.py'), with configurable latency, injected errors and limit of
+request size. It can be also started on its own, e.g.:
+
+    python fake_ckan.py --port 5055 --latency 0.05 --error-rate 0.01
+
+and then used as 'ckan_url' (http://127.0.0.1:5055) in config.ini.
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class FakeCkan:
+    """Fake CKAN server running in background thread.
+
+    latency: seconds added to each API call
+    latency_per_mb: seconds added to each API call per MiB of request body
+    error_rate: probability of 'datastore_upsert' failing with HTTP 503 (in
+        half of the cases after the records got stored)
+    max_body: requests bigger than this (in bytes, as received) fail with
+        HTTP 413
+    reject: records containing this string are rejected with HTTP 409 (as
+        CKAN does for invalid data)
+
+    Resources are kept in 'resources' (resource id -> dict with 'fields',
+    'primary_key' and 'rows', mapping primary keys to records) and counters
+    of calls in 'stats'."""
+
+    def __init__(self, port=0, latency=0.0, latency_per_mb=0.0, error_rate=0.0, max_body=None,
+            reject=None, seed=0):
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.error_rate = error_rate
+        self.max_body = max_body
+        self.reject = reject
+        self.random = random.Random(seed)
+
+        self.packages = {}
+        self.resources = {}
+        # action name -> counters, see 'count()'
+        self.stats = {}
+        # number of requests being handled now and the peak of it
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), FakeCkanHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def count(self, action, status, size, records):
+        """Note call of given action (answered with given HTTP status, with
+        given size of request body and number of records)."""
+
+        with self.lock:
+            stats = self.stats.setdefault(action, {'calls': 0, 'errors': 0, 'bytes': 0,
+                'records': 0})
+            stats['calls'] += 1
+            stats['bytes'] += size
+            if status == 200:
+                stats['records'] += records
+            else:
+                stats['errors'] += 1
+
+
+    def call(self, action, data, size):
+        """Handle given API action with given (decoded) data and size of the
+        request body. Returns HTTP status and response (dict)."""
+
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return self.handle(action, data, size)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+    def handle(self, action, data, size):
+        time.sleep(self.latency + self.latency_per_mb * size / 1024 / 1024)
+
+        if action == 'package_create':
+            return self.package_create(data)
+        if action == 'datastore_create':
+            return self.datastore_create(data)
+        if action == 'datastore_upsert':
+            with self.lock:
+                failure = self.error_rate > 0 and self.random.random() < self.error_rate
+                # half of the failures happen only after the records got stored
+                committed = failure and self.random.random() < 0.5
+            if failure and not committed:
+                return 503, error_response('Service Unavailable (injected)')
+            status, response = self.datastore_upsert(data)
+            if committed:
+                return 503, error_response('Service Unavailable (injected, after commit)')
+            return status, response
+        return 400, error_response('Unknown action %s' % action)
+
+
+    def package_create(self, data):
+        with self.lock:
+            if data['name'] in self.packages:
+                return 409, error_response('That URL is already in use.', 'Validation Error')
+            self.packages[data['name']] = data
+        return 200, {'success': True, 'result': {'id': data['name'], 'name': data['name']}}
+
+
+    def datastore_create(self, data):
+        package_id = data['resource']['package_id']
+        if package_id not in self.packages:
+            return 404, error_response('Package not found', 'Not Found Error')
+        resource_id = 'resource-%s' % package_id
+        primary_key = data.get('primary_key', [])
+        resource = {
+            'fields': [field['id'] for field in data['fields']],
+            'primary_key': [primary_key] if isinstance(primary_key, str) else primary_key,
+            'rows': {},
+        }
+        with self.lock:
+            self.resources[resource_id] = resource
+        status, response = self.store(resource, data.get('records', []), 'insert')
+        if status != 200:
+            return status, response
+        return 200, {'success': True, 'result': {'resource_id': resource_id}}
+
+
+    def datastore_upsert(self, data):
+        with self.lock:
+            resource = self.resources.get(data['resource_id'])
+        if resource is None:
+            return 404, error_response('Resource not found', 'Not Found Error')
+        return self.store(resource, data['records'], data.get('method', 'upsert'))
+
+
+    def store(self, resource, records, method):
+        """Store given records into given resource, all or nothing (as CKAN
+        does in one transaction)."""
+
+        fields = set(resource['fields'])
+        rows = {}
+        for record in records:
+            unknown = set(record) - fields
+            if len(unknown) > 0:
+                return 409, error_response('fields "%s" do not exist' % ', '.join(sorted(unknown)),
+                    'Validation Error')
+            if self.reject is not None and self.reject in json.dumps(record, ensure_ascii=False):
+                return 409, error_response('invalid record (rejected)', 'Validation Error')
+            key = tuple(record.get(field) for field in resource['primary_key'])
+            rows[key] = record
+
+        with self.lock:
+            if method == 'insert' and any(key in resource['rows'] for key in rows):
+                return 409, error_response('duplicate key value violates unique constraint',
+                    'Validation Error')
+            resource['rows'].update(rows)
+        return 200, {'success': True, 'result': {'method': method}}
+
+
+def error_response(message, error_type='Error'):
+    return {'success': False, 'error': {'__type': error_type, 'message': message}}
+
+
+class FakeCkanHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+    def respond(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_POST(self):
+        fake = self.server.fake
+        action = self.path.rsplit('/', 1)[-1]
+        body = self.read_body()
+        size = len(body)
+
+        if not self.headers.get('Authorization'):
+            status, response = 403, error_response('Access denied', 'Authorization Error')
+        elif fake.max_body is not None and size > fake.max_body:
+            status, response = 413, error_response('Request Entity Too Large')
+        else:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            data = json.loads(body)
+            status, response = fake.call(action, data, size)
+            fake.count(action, status, size, len(data.get('records', [])))
+            self.respond(status, response)
+            return
+
+        fake.count(action, status, size, 0)
+        self.respond(status, response)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds added to each API call')
+    parser.add_argument('--latency-per-mb', type=float, default=0.0,
+        help='seconds added to each API call per MiB of request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='probability of datastore_upsert failing with HTTP 503 (half of them after commit)')
+    parser.add_argument('--max-body', type=int,
+        help='requests bigger than this (in bytes) fail with HTTP 413')
+    parser.add_argument('--reject',
+        help='records containing this string are rejected with HTTP 409')
+    args = parser.parse_args()
+
+    fake = FakeCkan(args.port, args.latency, args.latency_per_mb, args.error_rate, args.max_body,
+        args.reject)
+    print('fake CKAN listening on %s' % fake.url)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for action, stats in sorted(fake.stats.items()):
+        print('%-20s %s' % (action, stats))
+    print('%-20s %d' % ('max in flight', fake.max_in_flight))
+    for resource_id, resource in sorted(fake.resources.items()):
+        print('%-40s %d rows' % (resource_id, len(resource['rows'])))